@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from scene import Scene
+
+# Persistent, on-disk cache of downloaded bands. Every entry is a directory
+# named by the hash of the request (collection, AOI, date and band set) that
+# holds one .npy file per band (so entries can be memory mapped on read) and the
+# Scene metadata (DN offset/scale, georeferencing) in bands.json.
+# Entries are written to a temporary directory and renamed into place, and there
+# is no shared index file, so several processes (e.g. over the ColonyOS fs mount)
+# can use the same cache directory at once.
+#
+# The ColonyOS fs mount copies the whole cache into every container before the job
+# starts, so the function specs leave it out (band_cache_dir ""): it is opt-in with
+# submit_jobs.py --band-cache-gb, with a cap small enough to sync quickly.
+
+CACHE_DIR = os.getenv("band_cache_dir", default="../cache")  # "" --> no caching
+CACHE_MAX_GB = float(os.getenv("band_cache_max_gb", default="2"))
+
+# Bump when the format of the cached arrays changes
+CACHE_VERSION = 3
+
+ACCESS_FILE = ".last_access"
+
+
+class BandCache():
+    """
+    Content-addressed band cache with a size cap and LRU eviction
+    """
+    def __init__(self, cache_dir: str = CACHE_DIR, max_gb: float = CACHE_MAX_GB):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_gb * 2**30)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(collection: str, coords: dict, date: str, bands: list, resolution: float = None) -> str:
+        request = {
+            "version": CACHE_VERSION,
+            "collection": collection,
+            "coords": {side: round(float(value), 7) for side, value in sorted(coords.items())},
+            "date": date,
+            "bands": sorted(band.upper() for band in bands),
+        }
+        if resolution:
+            request["resolution"] = float(resolution)
+        return hashlib.sha256(json.dumps(request, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _entry_dir(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, key: str) -> Scene:
+        entry_dir = self._entry_dir(key)
+        try:
+            with open(os.path.join(entry_dir, "bands.json")) as f:
+                entry = json.load(f)
+            data = Scene.from_meta({band: np.load(os.path.join(entry_dir, band + ".npy"), mmap_mode="r")
+                                    for band in entry["bands"]}, entry["meta"])
+        except (FileNotFoundError, ValueError):
+            self.misses += 1
+            return None
+
+        self._touch(entry_dir)
+        self.hits += 1
+        return data
+
+    def put(self, key: str, data: Scene):
+        os.makedirs(os.path.dirname(self._entry_dir(key)), exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=self.cache_dir)
+        try:
+            for band, array in data.items():
+                np.save(os.path.join(tmp_dir, band + ".npy"), array)
+            with open(os.path.join(tmp_dir, "bands.json"), "w") as f:
+                json.dump({"bands": list(data.keys()), "meta": data.meta()}, f)
+            self._touch(tmp_dir)
+            os.rename(tmp_dir, self._entry_dir(key))
+        except OSError:
+            # Most likely written concurrently by another process, keep that one
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+
+        self.evict()
+
+    def _touch(self, entry_dir: str):
+        with open(os.path.join(entry_dir, ACCESS_FILE), "w"):
+            pass
+
+    def _entries(self) -> list:
+        # [(last access, size in bytes, entry dir), ...]
+        entries = []
+        for prefix in os.listdir(self.cache_dir):
+            prefix_dir = os.path.join(self.cache_dir, prefix)
+            if prefix.startswith(".") or not os.path.isdir(prefix_dir):
+                continue
+            for key in os.listdir(prefix_dir):
+                entry_dir = os.path.join(prefix_dir, key)
+                try:
+                    files = [os.path.join(entry_dir, name) for name in os.listdir(entry_dir)]
+                    size = sum(os.path.getsize(path) for path in files)
+                    last_access = os.path.getmtime(os.path.join(entry_dir, ACCESS_FILE))
+                except OSError:
+                    continue
+                entries.append((last_access, size, entry_dir))
+        return entries
+
+    def evict(self):
+        # Drop least recently used entries until the cache fits within its cap
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry_dir in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses}
+
+
+# Process-level cache
+_cache = None
+
+def get_band_cache() -> BandCache:
+    global _cache
+    if _cache is None and CACHE_DIR:
+        _cache = BandCache()
+    return _cache
@@ -0,0 +1,125 @@
+import hashlib
+import json
+import struct
+import numpy as np
+
+# Packed MLP5 ensemble ("weight bundle") file layout:
+#   MAGIC | version (uint32) | header length (uint32) | JSON header | payload
+# The payload holds every array as float32, stacked over the ensemble members
+# and 64-byte aligned, so the whole bundle can be memory mapped as is.
+MAGIC = b"MLP5ENS\0"
+BUNDLE_VERSION = 1
+ALIGNMENT = 64
+
+LAYERS = ["lin1", "lin2", "lin3", "lin4", "lin5"]
+
+
+def _aligned(n: int) -> int:
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+class EnsembleBundle():
+    """
+    A loaded weight bundle: ensemble arrays plus the metadata needed to run it
+    """
+    def __init__(self, header: dict, arrays: dict):
+        self.header = header
+        self.arrays = arrays
+
+        self.source = header["source"]
+        self.collection = header["collection"]
+        self.bands = header["bands"]
+        self.means = np.asarray(header["means"], dtype=np.float32)
+        self.stds = np.asarray(header["stds"], dtype=np.float32)
+        self.cloud_thres = header["cloud_thres"]
+        self.thin_cloud_thres = header["thin_cloud_thres"]
+        self.apply_relu = header["apply_relu"]
+        self.nbr_models = header["nbr_models"]
+        self.digest = header["digest"]
+
+    def weights(self) -> list:
+        # Stacked, transposed weights: (nbr_models, in_dim, out_dim) per layer
+        return [self.arrays[layer + ".weight"] for layer in LAYERS]
+
+    def biases(self) -> list:
+        # Stacked biases: (nbr_models, 1, out_dim) per layer
+        return [self.arrays[layer + ".bias"] for layer in LAYERS]
+
+
+def pack_bundle(save_path: str, source: str, model_paths: list, bands: list, means, stds,
+                cloud_thres: float, thin_cloud_thres: float, collection: str, apply_relu: bool = True) -> str:
+    # torch is only needed to read the original checkpoints
+    import torch
+
+    state_dicts = [torch.load(path, map_location="cpu") for path in model_paths]
+
+    arrays = {}
+    for layer in LAYERS:
+        arrays[layer + ".weight"] = np.stack([sd[layer + ".weight"].numpy().T for sd in state_dicts])
+        arrays[layer + ".bias"] = np.stack([sd[layer + ".bias"].numpy()[np.newaxis, :] for sd in state_dicts])
+
+    # Lay out the payload
+    offset = 0
+    layout = {}
+    for name, array in arrays.items():
+        layout[name] = {"offset": offset, "shape": list(array.shape)}
+        offset = _aligned(offset + array.nbytes)
+    payload = bytearray(offset)
+    for name, array in arrays.items():
+        start = layout[name]["offset"]
+        payload[start : start + array.nbytes] = np.ascontiguousarray(array, dtype="<f4").tobytes()
+
+    header = {
+        "source": source,
+        "collection": collection,
+        "bands": list(bands),
+        "means": [float(m) for m in np.asarray(means)],
+        "stds": [float(s) for s in np.asarray(stds)],
+        "cloud_thres": cloud_thres,
+        "thin_cloud_thres": thin_cloud_thres,
+        "apply_relu": apply_relu,
+        "nbr_models": len(state_dicts),
+        "digest": hashlib.sha256(payload).hexdigest(),
+        "arrays": layout,
+    }
+    header_bytes = json.dumps(header).encode("utf-8")
+    preamble_len = len(MAGIC) + 8 + len(header_bytes)
+    header_bytes += b" " * (_aligned(preamble_len) - preamble_len)
+
+    with open(save_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<II", BUNDLE_VERSION, len(header_bytes)))
+        f.write(header_bytes)
+        f.write(payload)
+
+    return save_path
+
+
+def load_bundle(path: str) -> EnsembleBundle:
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not an MLP5 ensemble bundle")
+        version, header_len = struct.unpack("<II", f.read(8))
+        if version != BUNDLE_VERSION:
+            raise ValueError(f"{path} has bundle version {version}, expected {BUNDLE_VERSION}")
+        header = json.loads(f.read(header_len))
+
+    # Copy-on-write mapping: pages are shared between processes and only read on demand
+    payload = np.memmap(path, dtype="<f4", mode="c", offset=len(MAGIC) + 8 + header_len)
+    arrays = {}
+    for name, entry in header["arrays"].items():
+        start = entry["offset"] // 4
+        arrays[name] = payload[start : start + int(np.prod(entry["shape"]))].reshape(entry["shape"])
+
+    return EnsembleBundle(header, arrays)
+
+
+if __name__ == "__main__":
+    # Pack the ensembles defined in main.py into ../models/
+    from main import init_l1c, init_l2a, BUNDLE_PATH
+
+    for source, init_source in [("l1c", init_l1c), ("l2a", init_l2a)]:
+        _input_dim, paths, bands, means, stds, cloud_thres, thin_cloud_thres, collection = init_source()
+        save_path = pack_bundle(BUNDLE_PATH.format(source), source, ["../" + path for path in paths], bands,
+                                means, stds, cloud_thres, thin_cloud_thres, collection)
+        print("packed:", save_path)
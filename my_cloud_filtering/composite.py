@@ -0,0 +1,182 @@
+import datetime
+import json
+import os
+import time
+import numpy as np
+
+from contextlib import contextmanager
+
+from scene import DN_SCALE
+
+# Incremental best-pixel composite of an AOI. Per pixel, the state holds the latest
+# clear observation of some bands, the date it was made and how confidently it was
+# clear. Each new date only writes the pixels it changes, and a composite on disk is
+# memory mapped, so a daily update costs in proportion to the changed pixels rather
+# than to the length of the archive.
+#
+# Updates are read-modify-writes of the whole state, so writers that may run at the
+# same time (e.g. jobs with different dates of one AOI) take locked() around them.
+#
+# The composite's map (map.npy, 8-bit with a fixed reflectance stretch so that pixels of
+# different dates match) is kept next to the state and repainted at the changed pixels only.
+
+LOCK_TIMEOUT = 15 * 60  # Seconds after which a lock is taken to be left behind by a crashed writer
+NO_DATE = -1  # Date of pixels that have never been seen clear
+MIN_CONFIDENCE = 0.5  # A clear pixel with a lower confidence only fills pixels never seen clear
+MAP_MAX_REFLECTANCE = 0.3  # Reflectance shown as 255 in the map, pixels never seen clear are 0
+
+EPOCH = datetime.date(1970, 1, 1)
+
+
+def to_day(date: str) -> int:
+    return (datetime.date.fromisoformat(date) - EPOCH).days
+
+
+def from_day(day: int) -> str:
+    return (EPOCH + datetime.timedelta(days=int(day))).isoformat()
+
+
+@contextmanager
+def locked(path: str, timeout: float = LOCK_TIMEOUT, poll: float = 0.2):
+    # Exclusive lock on a composite (path + ".lock"), created atomically, so that it also
+    # works between processes and hosts sharing a filesystem
+    lock_path = path.rstrip(os.sep) + ".lock"
+    os.makedirs(os.path.dirname(lock_path) or ".", exist_ok=True)
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) > timeout:
+                    os.remove(lock_path)
+                    continue
+            except FileNotFoundError:
+                continue
+            time.sleep(poll)
+    try:
+        os.write(fd, f"{os.getpid()}\n".encode())
+        os.close(fd)
+        yield
+    finally:
+        os.remove(lock_path)
+
+
+def clear_confidence(cot: np.ndarray, thres: float) -> np.ndarray:
+    # 1 for a COT of 0, falling to 0 at the (thin) cloud threshold
+    conf = np.subtract(1, cot / thres, dtype=np.float32)
+    return np.clip(conf, 0, 1, out=conf)
+
+
+class Composite():
+    """
+    Per-pixel composite state: bands (bands, H, W) uint16 digital numbers with the
+    composite's DN offset, day (H, W) int32 days since 1970 and confidence (H, W) float16
+    """
+    def __init__(self, bands: np.ndarray, day: np.ndarray, confidence: np.ndarray, band_names: list,
+                 offset: float = 0, path: str = None):
+        self.bands = bands
+        self.day = day
+        self.confidence = confidence
+        self.band_names = list(band_names)
+        self.offset = offset
+        self.path = path
+
+    @classmethod
+    def empty(cls, shape: tuple, band_names: list, offset: float = 0):
+        return cls(np.zeros((len(band_names),) + tuple(shape), dtype=np.uint16),
+                   np.full(shape, NO_DATE, dtype=np.int32),
+                   np.zeros(shape, dtype=np.float16),
+                   band_names, offset)
+
+    @property
+    def shape(self) -> tuple:
+        return self.day.shape
+
+    def update(self, date: str, bands: np.ndarray, cloud_mask: np.ndarray, confidence: np.ndarray = None,
+               valid: np.ndarray = None, offset: float = None, min_confidence: float = MIN_CONFIDENCE) -> np.ndarray:
+        # Take in one date's observation: bands (bands, H, W) in digital numbers with the given
+        # DN offset (default: the composite's), its cloud mask and per-pixel clear confidence.
+        # A pixel is replaced if it is clear (and valid) now, was not seen clear on a later date,
+        # and is either confidently clear or has never been seen clear.
+        # Returns the flat indices of the changed pixels
+        day = to_day(date)
+        if confidence is None:
+            confidence = np.ones(self.shape, dtype=np.float32)
+
+        take = ~cloud_mask & (self.day <= day)
+        take &= (confidence >= min_confidence) | (self.day == NO_DATE)
+        if valid is not None:
+            take &= valid
+        changed = np.flatnonzero(take)
+        if changed.size == 0:
+            return changed
+
+        # Only the changed pixels are read and written
+        values = bands.reshape(bands.shape[0], -1)[:, changed]
+        if offset is not None and offset != self.offset:
+            values = values + (self.offset - offset)
+        self.bands.reshape(self.bands.shape[0], -1)[:, changed] = np.clip(np.rint(values), 0, np.iinfo(np.uint16).max)
+        self.day.reshape(-1)[changed] = day
+        self.confidence.reshape(-1)[changed] = confidence.reshape(-1)[changed]
+        return changed
+
+    def to_map(self, values: np.ndarray) -> np.ndarray:
+        # Digital numbers with the composite's offset --> map bytes
+        reflectance = np.subtract(values, self.offset, dtype=np.float32)
+        reflectance *= 255 * DN_SCALE / MAP_MAX_REFLECTANCE
+        reflectance += 0.5
+        return np.clip(reflectance, 0, 255, out=reflectance).astype(np.uint8)
+
+    def paint(self, image: np.ndarray, changed: np.ndarray) -> np.ndarray:
+        # Bring a (bands, H, W) uint8 map of the composite up to date, stretching only the changed pixels
+        image.reshape(image.shape[0], -1)[:, changed] = self.to_map(self.bands.reshape(self.bands.shape[0], -1)[:, changed])
+        return image
+
+    def open_map(self) -> np.ndarray:
+        # The map of a composite on disk, memory mapped. Painted whole if there is none yet
+        map_path = os.path.join(self.path, "map.npy")
+        if not os.path.exists(map_path):
+            tmp_path = os.path.join(self.path, ".tmp-map.npy")
+            np.save(tmp_path, self.paint(np.zeros(self.bands.shape, dtype=np.uint8), np.arange(self.day.size)))
+            os.replace(tmp_path, map_path)
+        return np.load(map_path, mmap_mode="r+")
+
+    def age(self, date: str) -> np.ndarray:
+        # Days since each pixel was last seen clear (-1 if never)
+        return np.where(self.day == NO_DATE, -1, to_day(date) - self.day)
+
+    def coverage(self) -> float:
+        # Percentage of the pixels seen clear at least once
+        return 100 * np.count_nonzero(self.day != NO_DATE) / self.day.size
+
+    def save(self, path: str) -> str:
+        # One .npy per state array, so that open() can memory map them
+        os.makedirs(path, exist_ok=True)
+        for name in ["bands", "day", "confidence"]:
+            np.save(os.path.join(path, name + ".npy"), getattr(self, name))
+        with open(os.path.join(path, "composite.json"), "w") as f:
+            json.dump({"band_names": self.band_names, "offset": self.offset}, f)
+        self.path = path
+        return path
+
+    def flush(self):
+        # Write back the changes of a composite opened from disk
+        for array in [self.bands, self.day, self.confidence]:
+            if isinstance(array, np.memmap):
+                array.flush()
+
+    @classmethod
+    def open(cls, path: str, mode: str = "r+"):
+        with open(os.path.join(path, "composite.json")) as f:
+            meta = json.load(f)
+        arrays = [np.load(os.path.join(path, name + ".npy"), mmap_mode=mode) for name in ["bands", "day", "confidence"]]
+        return cls(*arrays, meta["band_names"], meta["offset"], path)
+
+    @classmethod
+    def open_or_create(cls, path: str, shape: tuple, band_names: list, offset: float = 0):
+        if os.path.exists(os.path.join(path, "composite.json")):
+            return cls.open(path)
+        composite = cls.empty(shape, band_names, offset)
+        composite.save(path)
+        return cls.open(path)
@@ -0,0 +1,92 @@
+import queue
+import threading
+import time
+import openeo
+
+from contextlib import contextmanager
+from openeo.rest import OpenEoApiError
+
+from config import *
+
+# Re-authenticate proactively after this many seconds, well before the
+# backend's bearer tokens run out
+TOKEN_LIFETIME = 30 * 60
+
+# Error codes the backend answers with when a token has expired or is missing
+AUTH_ERROR_CODES = ("TokenInvalid", "AuthenticationRequired", "AuthenticationSchemeInvalid")
+
+
+class EOSession():
+    """
+    One authenticated openEO connection, reused across requests, that
+    re-authenticates when its token expires
+    """
+    def __init__(self, url: str = None, username: str = None, password: str = None,
+                 token_lifetime: float = TOKEN_LIFETIME, default_timeout: int = None):
+        self.url = url or eo_service_url
+        self.username = username or user
+        self.password = password or passwd
+        self.token_lifetime = token_lifetime
+        self.default_timeout = default_timeout
+
+        self._lock = threading.Lock()
+        self._connection = None
+        self._auth_time = None
+
+    def connection(self) -> openeo.Connection:
+        with self._lock:
+            if self._connection is None:
+                self._connection = openeo.connect(self.url, default_timeout=self.default_timeout)
+            if self._auth_time is None or time.monotonic() - self._auth_time > self.token_lifetime:
+                self._connection.authenticate_basic(username=self.username, password=self.password)
+                self._auth_time = time.monotonic()
+            return self._connection
+
+    def invalidate(self):
+        # Force a new login on the next request
+        with self._lock:
+            self._auth_time = None
+
+    def run(self, request):
+        # request(connection) --> result, retried once after re-authenticating
+        # if the backend rejected the token
+        try:
+            return request(self.connection())
+        except OpenEoApiError as e:
+            if e.http_status_code != 401 and e.code not in AUTH_ERROR_CODES:
+                raise
+            self.invalidate()
+            return request(self.connection())
+
+
+class SessionPool():
+    """
+    A fixed number of sessions handed out to concurrent users, one at a time each
+    """
+    def __init__(self, size: int, **session_kwargs):
+        self.size = size
+        self._sessions = queue.Queue()
+        for _ in range(size):
+            # Connections are only opened on first use
+            self._sessions.put(EOSession(**session_kwargs))
+
+    @contextmanager
+    def session(self):
+        session = self._sessions.get()
+        try:
+            yield session
+        finally:
+            self._sessions.put(session)
+
+
+# Process-level pool
+_pool = None
+_lock = threading.Lock()
+
+def get_pool(size: int = 4, **session_kwargs) -> SessionPool:
+    # Created on first call, later calls share it as is
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = SessionPool(size, **session_kwargs)
+        return _pool
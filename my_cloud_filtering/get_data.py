@@ -1,48 +1,28 @@
-import matplotlib.pyplot as plt
 import numpy as np
-import openeo
 import os
-import io
 import rasterio
+import time
 
+from rasterio.io import MemoryFile
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from datetime import datetime, timedelta
 
-from config import *
-from PIL import Image
-
-def pool_bands(data: dict, min_band_dim: int, func=Image.LANCZOS) -> dict:
-    # Functions to use: Image.LANCZOS, Image.BILINEAR, ...
-
-    resized_data = []
-    for channel in [*data.values()]:
-        if not channel.shape[0] == min_band_dim[0]:
-            # down_scale_factor = np.round(channel.shape[0] / min_band_dim[0])
-            # channel = block_reduce(channel, block_size=(down_scale_factor, down_scale_factor), func=np.mean)
-            # channel = channel.resize()
-            channel = Image.fromarray(channel)
-            channel = channel.resize((min_band_dim[1], min_band_dim[0]), resample=func)
-            channel = np.asarray(channel)
-
-        resized_data.append(channel)
-    return np.asarray(resized_data)
-
-def interpolate_bands(data: dict, max_band_dim: int, func=Image.LANCZOS) -> dict:
-    # Functions to use: Image.LANCZOS, Image.BILINEAR, ...
-
-    resized_data = []
-    for channel in [*data.values()]:
-        if not channel.shape[0] == max_band_dim[0]:
-            # up_scale_factor = int(max_band_dim / channel.shape[0])
-            # channel = zoom(channel, (up_scale_factor, up_scale_factor), order=1)
-            channel = Image.fromarray(channel)
-            channel = channel.resize((max_band_dim[1], max_band_dim[0]), resample=func)
-            channel = np.asarray(channel)
-
-        resized_data.append(channel)
-    return np.asarray(resized_data)
+from eo_session import get_pool
+from band_cache import get_band_cache
+from scene import Scene
+from resample import resample_stack
+from stretch import stretch_params, apply_stretch
+
+def pool_bands(data: dict, min_band_dim: int, func: str = "lanczos") -> np.ndarray:
+    # Kernels to use: "lanczos", "bilinear", "box" (integer ratios are always exact block means)
+    return resample_stack([*data.values()], min_band_dim, kernel=func)
+
+def interpolate_bands(data: dict, max_band_dim: int, func: str = "lanczos") -> np.ndarray:
+    # Kernels to use: "lanczos", "bilinear", "box"
+    return resample_stack([*data.values()], max_band_dim, kernel=func)
     
 
-def get_product(data:dict, band_list: list = [], scaling: str = "upsizing", scaling_function=Image.LANCZOS) -> np.ndarray:
+def get_product(data:dict, band_list: list = [], scaling: str = "upsizing", scaling_function: str = "lanczos") -> np.ndarray:
     # Scaling methods to use are either upsizing (interpolation e.g. 200x200 -> 400x400)
     #       or downsizing (pooling e.g. 400x400 -> 200x200))
 
@@ -63,9 +43,31 @@ def get_product(data:dict, band_list: list = [], scaling: str = "upsizing", scal
     
     return array_data
 
+def _band_index(indices: list):
+    # Evenly spaced indices as a slice (so indexing gives a view), else as they are
+    if len(indices) == 1:
+        return slice(indices[0], indices[0] + 1)
+    step = indices[1] - indices[0]
+    if step != 0 and all(b - a == step for a, b in zip(indices, indices[1:])):
+        stop = indices[-1] + step
+        return slice(indices[0], stop if stop >= 0 else None, step)
+    return indices
+
+def get_products(data: dict, products: dict, scaling: str = "upsizing", scaling_function: str = "lanczos") -> dict:
+    # products: {name: band list}. Every band used by any product is resampled once into a
+    # single aligned (bands, H, W) stack, with the bands of the first product leading.
+    # Each product is an index view of that stack (a copy only if its bands are not evenly spaced in it)
+    band_list = []
+    for product_bands in products.values():
+        band_list += [band for band in product_bands if band not in band_list]
+
+    stack = get_product(data, band_list, scaling=scaling, scaling_function=scaling_function)
+    return {name: stack[_band_index([band_list.index(band) for band in product_bands])]
+            for name, product_bands in products.items()}
+
 def get_l1c_data():
     base_path = "../data/l1c/"
-    data = {}
+    data = Scene(offset=1000)
 
     for i in range(1, 13):
 
@@ -73,17 +75,74 @@ def get_l1c_data():
         filename = "T34WES_20240904T100551_"+channel+".jp2"
 
         with rasterio.open(base_path+filename) as dataset:
-            data[channel] = (dataset.read(1) - 1000) / 10000
+            data[channel] = dataset.read(1)
+            if channel == "B02":
+                data.transform, data.crs = affine_tuple(dataset.transform), dataset.crs.to_string()
 
     with rasterio.open(base_path+"T34WES_20240904T100551_B8A.jp2") as dataset:
-            data["B8A"] = (dataset.read(1) - 1000) / 10000
+            data["B8A"] = dataset.read(1)
 
     return data
 
-def download_eo_data(params) -> list:
+def read_gtiff(payload: bytes) -> tuple:
+    # Open an in-memory GeoTIFF once and read all of its bands with a single read()
+    # into one contiguous (bands, H, W) array. Returns the array and the dataset's
+    # georeferencing and tags
+    with MemoryFile(payload) as memfile:
+        with memfile.open() as dataset:
+            stack = dataset.read()
+            meta = {"transform": dataset.transform, "crs": dataset.crs, "tags": dataset.tags()}
+    return stack, meta
+
+def affine_tuple(transform) -> tuple:
+    # Affine geotransform --> (a, b, c, d, e, f), as stored with a Scene
+    return (transform.a, transform.b, transform.c, transform.d, transform.e, transform.f)
+
+def dn_offset(timestamp: str) -> int:
+    # Sentinel-2 products from 2022 on carry a +1000 DN radiometric offset
+    return 1000 if datetime.fromisoformat(timestamp.split("T")[0]) >= datetime(2022, 1, 1) else 0
+
+# Scene classification classes: cloud shadows, cloud medium/high probability and thin cirrus
+SCL_CLOUD_CLASSES = [3, 8, 9, 10]
+SCL_NO_DATA = 0
+
+DOWNLOAD_WORKERS = 3  # Concurrent openEO requests (resolution groups, dates, AOIs)
+DOWNLOAD_TIMEOUT = 600  # Seconds before a single openEO request is given up on
+
+# Bands needed by each output product, on top of the model input bands
+PRODUCT_BANDS = {
+    "rgb": ["B04", "B03", "B02"],
+}
+
+def required_bands(model_bands: list, products: list = []) -> list:
+    # Minimal band set for a model and the requested output products, in first-seen order
+    bands = list(model_bands)
+    for product in products:
+        bands += [band for band in PRODUCT_BANDS[product] if band not in bands]
+    return bands
+
+def _download_group(pool, collection: str, coords: dict, date: datetime, bands: list, resolution: float = None) -> bytes:
+    # Each concurrent request gets a connection of its own from the pool
+    with pool.session() as session:
+        def request(connect):
+            cube = connect.load_collection(
+                collection_id=collection,
+                spatial_extent=coords,
+                temporal_extent=[date, (date + timedelta(days=1))],
+                bands=bands
+            )
+            if resolution:
+                # Let the backend bring every band to one grid, block-averaging finer bands
+                cube = cube.resample_spatial(resolution=resolution, method="average")
+            return cube.download(format="gtiff")
+        return session.run(request)
+
+def download_eo_data(params, pool=None) -> list:
+    # pool: an eo_session.SessionPool, by default the process-wide one
+    # params["geojson"]["resolution"] (m, optional): resample server-side and download all bands at once
     
     l2a_bands_resolutions = {
-            "60": ["B01", "b09"],
+            "60": ["b01", "b09", "b10"],
             "10": ["b02", "b03", "b04", "b08"],
             "20": ["b05", "b06", "b07", "b8a", "b11", "b12", "scl", "cld", "snw", "wvp", "aot"]}
 
@@ -105,39 +164,74 @@ def download_eo_data(params) -> list:
     for res, bands in l2a_bands_resolutions.items():
         bands_by_resolution[res] = [band for band in bands if band in bands_params]
     
-    image_data = {}
-    for _resolution, bands in bands_by_resolution.items():
-        # Bands list not empty, try downloading the band data
-        if bands:
-            try:
-                connect = openeo.connect(eo_service_url)
-                connect.authenticate_basic(username=user, password=passwd)
-
-                cube = connect.load_collection(
-                    collection_id=collection,
-                    spatial_extent=coords,
-                    temporal_extent=[date, (date + timedelta(days=1))],
-                    bands=bands
-                )
-                downloaded_data = cube.download(format="gtiff")
-                for i, band in enumerate(bands):
-
-                    filelike = io.BytesIO(downloaded_data)
-                    im = rasterio.open(filelike)
-                    timestamp =  im.tags()["timestamp"]
-
-                    if datetime.fromisoformat(timestamp.split("T")[0]) >= datetime(2022, 1, 1): 
-                        image_data[band.upper()] = (im.read(i+1) - 1000) / 10000
-                    else:
-                        image_data[band.upper()] = im.read(i+1) / 10000
-
-            except Exception as e:
-                if "Collection can not be found with the given parameters" in str(e):
-                    print("Could not find data for that date/area")
-                return
+    resolution = params.get("resolution")
+    if resolution:
+        bands_by_resolution = {str(resolution): sum(bands_by_resolution.values(), [])}
+
+    # Serve repeated requests from the on-disk band cache
+    cache = get_band_cache()
+    if cache is not None:
+        cache_key = cache.key(collection, coords, params["time"]["date"], sum(bands_by_resolution.values(), []), resolution)
+        image_data = cache.get(cache_key)
+        if image_data is not None:
+            return image_data
+
+    # Authenticated connections, reused for all resolution groups (and calls)
+    if pool is None:
+        pool = get_pool(DOWNLOAD_WORKERS, default_timeout=DOWNLOAD_TIMEOUT)
+
+    # Fetch the resolution groups concurrently, then assemble them in order. The groups
+    # share one deadline, and on failure the executor is not waited for: a hung request
+    # cannot be interrupted, it is left to the connection's own timeout in the background
+    groups = [bands for bands in bands_by_resolution.values() if bands]
+    image_data = Scene()
+    executor = ThreadPoolExecutor(max_workers=max(1, len(groups)))
+    futures = [executor.submit(_download_group, pool, collection, coords, date, bands, resolution) for bands in groups]
+    deadline = time.monotonic() + DOWNLOAD_TIMEOUT
+    try:
+        for bands, future in zip(groups, futures):
+            stack, meta = read_gtiff(future.result(timeout=max(0, deadline - time.monotonic())))
+
+            # Bands stay raw digital numbers (views into the group's stack), the
+            # offset/scale are applied in float32 at inference time
+            for i, band in enumerate(bands):
+                image_data[band.upper()] = stack[i]
+            image_data.offset = dn_offset(meta["tags"]["timestamp"])
+
+            # Georeference by the finest grid
+            if image_data.transform is None or abs(meta["transform"].a) < abs(image_data.transform[0]):
+                image_data.transform, image_data.crs = affine_tuple(meta["transform"]), meta["crs"].to_string()
+
+    except Exception as e:
+        if "Collection can not be found with the given parameters" in str(e):
+            print("Could not find data for that date/area")
+        elif isinstance(e, FutureTimeoutError):
+            print(f"Download timed out after {DOWNLOAD_TIMEOUT} s")
+        executor.shutdown(wait=False, cancel_futures=True)
+        return
+    executor.shutdown()
+
+    if cache is not None:
+        cache.put(cache_key, image_data)
 
     return image_data
 
+def scl_cloud_fraction(scl: np.ndarray) -> float:
+    # Percentage of the valid pixels that the scene classification marks as cloud or cloud shadow
+    valid = np.count_nonzero(scl != SCL_NO_DATA)
+    if valid == 0:
+        return None
+    return float(100 * np.count_nonzero(np.isin(scl, SCL_CLOUD_CLASSES)) / valid)
+
+def get_scl_cloud_fraction(params: dict) -> float:
+    # Download only the (20 m) scene classification band and compute its cloud fraction.
+    # Always at its native resolution, class codes must not be averaged
+    scl_params = {"geojson": {**params["geojson"], "bands": ["scl"], "resolution": None}}
+    data = download_eo_data(scl_params)
+    if data == None:
+        return None
+    return scl_cloud_fraction(data["SCL"])
+
 def get_l2a_data(params):
     return download_eo_data(params)
 
@@ -181,13 +275,11 @@ def get_data(source: str = "l1c", date="2022-01-06", params=None) -> dict:
         return None
 
 
-def normalize(data:np.ndarray, _type:str = "float") -> np.ndarray:
-    for i in range(data.shape[0]):
-        channel = data[i, ...]
-        channel_min, channel_max = np.percentile(channel, (2, 98))  # Clip values between 1st and 99th percentile
-        channel = np.clip(channel, channel_min, channel_max)  # Clip the extreme values
-        channel = ((channel - channel_min) / (channel_max - channel_min) * (255 if _type == "int" else 1))
-        data[i, ...] = channel
+def normalize(data:np.ndarray, _type:str = "float", params: tuple = None) -> np.ndarray:
+    # Stretch each channel between its 2nd and 98th percentile, in place for float data.
+    # params: (low, high) from stretch_params, e.g. computed once over all tiles of a mosaic
+    low, high = stretch_params(data) if params is None else params
+    data = apply_stretch(data, low, high, 255 if _type == "int" else 1)
 
     return (data.astype(np.uint8) if _type == "int" else data)
 
@@ -205,6 +297,9 @@ def filter_array_by_bands(array:np.ndarray, array_bands: list, target_bands:list
     return array[indices]
 
 def plot(data, save_name: str = None) -> None:
+    # For interactive use only, production code writes its outputs with writer.py
+    import matplotlib.pyplot as plt
+
     plt.imshow(np.transpose(data, (1, 2, 0)))
 
     if save_name:
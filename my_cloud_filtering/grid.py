@@ -0,0 +1,42 @@
+import datetime
+import math
+
+# Regular lat/lon tiling of bounding boxes, and date ranges. Kept free of heavy imports,
+# so that it can also be used where jobs are planned (see ../submit_jobs.py).
+
+METERS_PER_DEGREE_LATITUDE = 40007863 / 360
+
+def latitude_to_meters(latitude):
+    # Length of one degree of longitude at the given latitude
+    return 40075017 / 360 * math.cos(math.radians(latitude)) # In m
+
+def partition_coords(coords: dict, tile_km: float = 8.0) -> tuple:
+    # Split a bounding box into a regular lat/lon grid of (about) tile_km x tile_km tiles.
+    # Row 0 is the northernmost row. The longitude step is taken at the middle latitude
+    # of the box, so tiles get slightly narrower (wider) towards the north (south).
+    # Returns the tiles [(row, col, tile_coords), ...], the grid shape and its
+    # geotransform (west, lon step, north, lat step)
+    dlat = tile_km * 1000 / METERS_PER_DEGREE_LATITUDE
+    dlon = tile_km * 1000 / latitude_to_meters((coords["north"] + coords["south"]) / 2)
+
+    n_rows = max(1, math.ceil((coords["north"] - coords["south"]) / dlat))
+    n_cols = max(1, math.ceil((coords["east"] - coords["west"]) / dlon))
+
+    tiles = []
+    for row in range(n_rows):
+        north = coords["north"] - row * dlat
+        for col in range(n_cols):
+            west = coords["west"] + col * dlon
+            tiles.append((row, col, {
+                "west": west,
+                "east": min(west + dlon, coords["east"]),
+                "south": max(north - dlat, coords["south"]),
+                "north": north}))
+
+    return tiles, (n_rows, n_cols), (coords["west"], dlon, coords["north"], dlat)
+
+def date_range(start_date: str, end_date: str) -> list:
+    # All days from start_date to end_date, both included
+    start = datetime.date.fromisoformat(start_date)
+    nbr_days = (datetime.date.fromisoformat(end_date) - start).days + 1
+    return [(start + datetime.timedelta(days=i)).isoformat() for i in range(nbr_days)]
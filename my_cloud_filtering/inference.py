@@ -0,0 +1,315 @@
+import numpy as np
+
+# NB: torch is only imported when the torch backend is used, so that workers
+# running the NumPy backend never pay for importing it
+
+# Largest pixel block pushed through the ensemble at once; keeps the stacked
+# (nbr_models, block, hidden_dim) activations cache-resident
+ENSEMBLE_BLOCK_SIZE = 2048
+
+# 99% quantiles of Student's t distribution by degrees of freedom, for the adaptive
+# ensemble's tolerance (the normal quantile beyond the table)
+T_QUANTILES_99 = {1: 31.82, 2: 6.965, 3: 4.541, 4: 3.747, 5: 3.365, 6: 3.143, 7: 2.998, 8: 2.896, 9: 2.821}
+Z_QUANTILE_99 = 2.326
+
+
+class NumpyEnsemble():
+    """
+    Torch-free evaluation of a stacked MLP5 ensemble, using float32 BLAS matmuls
+    """
+    def __init__(self, weights, biases, apply_relu=True):
+        # Same layout as model.MLP5Ensemble: weights (nbr_models, in_dim, out_dim),
+        # biases (nbr_models, 1, out_dim)
+        self.weights = [np.asarray(weight, dtype=np.float32) for weight in weights]
+        self.biases = [np.asarray(bias, dtype=np.float32) for bias in biases]
+        self.apply_relu = apply_relu
+
+    @classmethod
+    def from_models(cls, models):
+        layers = ['lin1', 'lin2', 'lin3', 'lin4', 'lin5']
+        weights = [np.stack([getattr(model, layer).weight.detach().cpu().numpy().T for model in models]) for layer in layers]
+        biases = [np.stack([getattr(model, layer).bias.detach().cpu().numpy()[np.newaxis, :] for model in models]) for layer in layers]
+        return cls(weights, biases, models[0].apply_relu)
+
+    @classmethod
+    def from_bundle(cls, bundle):
+        return cls(bundle.weights(), bundle.biases(), bundle.apply_relu)
+
+    def __len__(self):
+        return self.weights[0].shape[0]
+
+    def predict(self, x, members=slice(None)):
+        # x: (N, input_dim) float32 --> (nbr_models, N, output_dim), optionally
+        # only for a slice of the ensemble members
+        x = np.matmul(x[np.newaxis], self.weights[0][members])
+        x += self.biases[0][members]
+        np.maximum(x, 0, out=x)
+        buf = np.empty_like(x)
+        for weight, bias in zip(self.weights[1:-1], self.biases[1:-1]):
+            np.matmul(x, weight[members], out=buf)
+            buf += bias[members]
+            np.maximum(buf, 0, out=buf)
+            x, buf = buf, x
+        x = np.matmul(x, self.weights[-1][members])
+        x += self.biases[-1][members]
+        if self.apply_relu:
+            np.maximum(x[:, :, 0], 0, out=x[:, :, 0])  # NB: cloud optical thicknesses cannot be negative
+        return x
+
+
+def load_ensemble(bundle, backend='torch', device='cpu'):
+    if backend == 'numpy':
+        return NumpyEnsemble.from_bundle(bundle)
+    from model import MLP5Ensemble
+    return MLP5Ensemble.from_bundle(bundle).to(device)
+
+
+def _get_ensemble(models, backend, device):
+    # models may be a ready ensemble (from load_ensemble) or a list of MLP5 models
+    if hasattr(models, 'predict'):
+        return models
+    if backend == 'numpy':
+        return NumpyEnsemble.from_models(models)
+    from model import MLP5Ensemble
+    return MLP5Ensemble.from_models(models).to(device)
+
+
+# def _mlp_post_filter(pred_map_binary_list, pred_map_binary_thin_list, pred_map, thresh_thin_cloud, post_filt_sz):
+# 	if post_filt_sz == 1:
+# 		return pred_map_binary_list, pred_map_binary_thin_list
+# 	H, W = pred_map.shape
+# 	for list_idx, pred_map_binary in enumerate(pred_map_binary_list):
+# 		tmp_map = np.zeros_like(pred_map)
+# 		tmp_map_thin = np.zeros_like(pred_map)
+# 		count_map = np.zeros_like(pred_map)
+# 		for i_start in range(post_filt_sz):
+# 			for j_start in range(post_filt_sz):
+# 				for i in range(i_start, H // post_filt_sz):
+# 					for j in range(j_start, W // post_filt_sz):
+# 						count_map[i * post_filt_sz : (i + 1) * post_filt_sz, j * post_filt_sz : (j + 1) * post_filt_sz] += 1
+# 						curr_patch = pred_map_binary[i * post_filt_sz : (i + 1) * post_filt_sz, j * post_filt_sz : (j + 1) * post_filt_sz]
+# 						curr_patch_thin = pred_map_binary_thin_list[min(list_idx, len(thresh_thin_cloud) - 1)][i * post_filt_sz : (i + 1) * post_filt_sz, j * post_filt_sz : (j + 1) * post_filt_sz]
+# 						if np.count_nonzero(curr_patch) >= np.prod(curr_patch.shape) // 2:
+# 							tmp_map[i * post_filt_sz : (i + 1) * post_filt_sz, j * post_filt_sz : (j + 1) * post_filt_sz] += 1
+# 						if np.count_nonzero(curr_patch_thin) >= np.prod(curr_patch_thin.shape) // 2:
+# 							tmp_map_thin[i * post_filt_sz : (i + 1) * post_filt_sz, j * post_filt_sz : (j + 1) * post_filt_sz] += 1
+# 		tmp_map[count_map == 0] = 0
+# 		count_map[count_map == 0] = 1
+# 		tmp_map /= count_map
+# 		assert np.min(tmp_map) >= 0 and np.max(tmp_map) <= 1
+# 		pred_map_binary = tmp_map >= 0.50
+# 		pred_map_binary_list[list_idx] = pred_map_binary
+
+# 		tmp_map_thin[count_map == 0] = 0
+# 		tmp_map_thin /= count_map
+# 		assert np.min(tmp_map_thin) >= 0 and np.max(tmp_map_thin) <= 1
+# 		pred_map_binary_thin = tmp_map_thin >= 0.50
+# 		pred_map_binary_thin_list[min(list_idx, len(thresh_thin_cloud) - 1)] = pred_map_binary_thin
+
+# 		# 'Aliasing effect' after this filtering can cause BOTH thin and regular cloud to be active at the same time -- give prevalence to regular
+# 		pred_map_binary_thin_list[0][pred_map_binary_list[0]] = 0
+
+# 	return pred_map_binary_list, pred_map_binary_thin_list
+
+def _block_majority(binary, post_filt_sz):
+    # Majority vote within non-overlapping post_filt_sz-squares (smaller squares
+    # along the bottom/right edges), computed with strided block sums
+    H, W = binary.shape
+    row_starts = np.arange(0, H, post_filt_sz)
+    col_starts = np.arange(0, W, post_filt_sz)
+    counts = np.add.reduceat(np.add.reduceat(binary.astype(np.int32), row_starts, axis=0), col_starts, axis=1)
+    sizes = np.outer(np.diff(row_starts, append=H), np.diff(col_starts, append=W))
+    votes = counts >= sizes // 2
+    return np.repeat(np.repeat(votes, post_filt_sz, axis=0)[:H], post_filt_sz, axis=1)[:, :W]
+
+def _integral_image(image):
+    integral = np.zeros((image.shape[0] + 1, image.shape[1] + 1), dtype=np.int64)
+    np.cumsum(np.cumsum(image, axis=0), axis=1, out=integral[1:, 1:])
+    return integral
+
+def _sliding_majority(binary, post_filt_sz):
+    # Every full post_filt_sz-window (at every offset) casts a majority vote, and a
+    # pixel is set if at least half of the windows covering it voted for it.
+    # Both stages are box sums, so each uses one integral image
+    H, W = binary.shape
+    if H < post_filt_sz or W < post_filt_sz:
+        return np.zeros_like(binary, dtype=bool)
+    k = post_filt_sz
+    integral = _integral_image(binary)
+    counts = integral[k:, k:] - integral[:-k, k:] - integral[k:, :-k] + integral[:-k, :-k]
+    votes = _integral_image(counts >= (k * k) // 2)
+
+    # Range of window origins covering each row/column
+    row_lo = np.clip(np.arange(H) - k + 1, 0, H - k)
+    row_hi = np.minimum(np.arange(H), H - k) + 1
+    col_lo = np.clip(np.arange(W) - k + 1, 0, W - k)
+    col_hi = np.minimum(np.arange(W), W - k) + 1
+    pos_votes = (votes[np.ix_(row_hi, col_hi)] - votes[np.ix_(row_lo, col_hi)]
+                 - votes[np.ix_(row_hi, col_lo)] + votes[np.ix_(row_lo, col_lo)])
+    nbr_windows = np.outer(row_hi - row_lo, col_hi - col_lo)
+    return 2 * pos_votes >= nbr_windows
+
+def _mlp_post_filter(pred_map_binary_list, pred_map_binary_thin_list, pred_map, thresh_thin_cloud, post_filt_sz, sliding=False):
+    if post_filt_sz == 1:
+        return pred_map_binary_list, pred_map_binary_thin_list
+
+    majority = _sliding_majority if sliding else _block_majority
+
+    for list_idx, pred_map_binary in enumerate(pred_map_binary_list):
+        thin_idx = min(list_idx, len(thresh_thin_cloud) - 1)
+
+        # Threshold maps
+        pred_map_binary_list[list_idx] = majority(pred_map_binary, post_filt_sz)
+        pred_map_binary_thin_list[thin_idx] = majority(pred_map_binary_thin_list[thin_idx], post_filt_sz)
+
+        # Resolve conflicts between thin and regular cloud maps
+        pred_map_binary_thin_list[0][pred_map_binary_list[0]] = 0
+
+    return pred_map_binary_list, pred_map_binary_thin_list
+
+def _adaptive_ensemble_sum(ensemble, x, out, thresholds, nbr_first, margin):
+    # Evaluate the first nbr_first members for all pixels, and the rest only for
+    # pixels whose running mean is not confidently on one side of every threshold.
+    # Writes the member-sum (scaled partial mean for finalized pixels) into out
+    # and returns the number of skipped pixel-model evaluations
+    nbr_models = len(ensemble)
+    first = ensemble.predict(x, members=slice(0, nbr_first))[:, :, 0]
+    mean = first.mean(axis=0)
+
+    # 99% bound on the final mean's distance from the running one, if the remaining
+    # members behave like the first ones. The spread is estimated from few members,
+    # hence the t quantile, and margin is a floor for pixels where they happen to agree
+    nbr_rest = nbr_models - nbr_first
+    spread = nbr_rest / nbr_models * first.std(axis=0, ddof=1) * np.sqrt(1 / nbr_rest + 1 / nbr_first)
+    tolerance = margin + T_QUANTILES_99.get(nbr_first - 1, Z_QUANTILE_99) * spread
+
+    # A member clamped at COT 0 (by the output ReLU) hides how far below zero it is,
+    # so the spread says nothing there: such pixels always get the whole ensemble
+    ambiguous = np.any(first <= 0, axis=0)
+    for thresh in thresholds:
+        ambiguous |= np.abs(mean - thresh) <= tolerance
+
+    np.multiply(mean, nbr_models, out=out)
+    if ambiguous.any():
+        rest = ensemble.predict(np.ascontiguousarray(x[ambiguous]), members=slice(nbr_first, None))[:, :, 0]
+        out[ambiguous] = first[:, ambiguous].sum(axis=0) + rest.sum(axis=0)
+    return nbr_rest * (len(mean) - np.count_nonzero(ambiguous))
+
+def _rows_per_tile(mem_budget_mb, W, input_dim, ensemble):
+    # Working set of one image row: the float32 input copy, its prediction and
+    # the boolean maps written per threshold
+    row_bytes = W * (4 * input_dim + 4 + 8)
+    nbr_models, _, hidden_dim = ensemble.weights[0].shape
+    ensemble_bytes = 2 * 4 * ENSEMBLE_BLOCK_SIZE * nbr_models * hidden_dim
+    return max(1, (int(mem_budget_mb * 2**20) - ensemble_bytes) // row_bytes)
+
+# Setup MLP-computation function
+def mlp_inference(img, means, stds, models, batch_size, thresh_cloud, thresh_thin_cloud, post_filt_sz, device='cpu', predict_also_cloud_binary=False, mem_budget_mb=None, backend='torch', post_filt_sliding=False,
+                  adaptive=False, adaptive_first=5, adaptive_margin=0.005, stats=None):
+    # adaptive: finalize pixels far from all thresholds after the first adaptive_first members,
+    # see _adaptive_ensemble_sum. Their COT is then the mean over those members only.
+    # stats (dict): filled with the number of pixel-model evaluations done and skipped
+    H, W, input_dim = img.shape
+    means = np.asarray(means, dtype=np.float32)
+    inv_stds = 1 / np.asarray(stds, dtype=np.float32)
+
+    # All ensemble members are evaluated together, block by block, and their
+    # outputs are summed straight into the (float32) result maps
+    ensemble = _get_ensemble(models, backend, device)
+    batch_size = min(batch_size, ENSEMBLE_BLOCK_SIZE)
+    adaptive = adaptive and not predict_also_cloud_binary and 2 <= adaptive_first < len(ensemble)
+    nbr_skipped = 0
+
+    # Preallocated outputs, filled tile by tile
+    pred_map = np.empty((H, W), dtype=np.float32)
+    pred_map_binary_list = [np.empty((H, W), dtype=bool) for _ in ([None] if predict_also_cloud_binary else thresh_cloud)]
+    pred_map_binary_thin_list = [np.empty((H, W), dtype=bool) for _ in thresh_thin_cloud]
+
+    # Stream tiles of whole rows through normalization, the ensemble and thresholding,
+    # so that memory use is bounded by mem_budget_mb rather than by the image size
+    tile_rows = H if mem_budget_mb is None else _rows_per_tile(mem_budget_mb, W, input_dim, ensemble)
+    for r in range(0, H, tile_rows):
+        # img may be any (e.g. uint16 or strided) array, the cast and centering are one pass
+        tile = np.subtract(img[r : r + tile_rows], means, dtype=np.float32, order='C').reshape(-1, input_dim)
+        tile *= inv_stds
+        tile_pred = np.empty(tile.shape[0], dtype=np.float32)
+        tile_votes = np.empty(tile.shape[0], dtype=np.int64)
+        for i in range(0, tile.shape[0], batch_size):
+            if adaptive:
+                nbr_skipped += _adaptive_ensemble_sum(ensemble, tile[i : i + batch_size, :], tile_pred[i : i + batch_size],
+                                                      [*thresh_cloud, *thresh_thin_cloud], adaptive_first, adaptive_margin)
+                continue
+            curr_pred = ensemble.predict(tile[i : i + batch_size, :])
+            np.sum(curr_pred[:, :, 0], axis=0, out=tile_pred[i : i + batch_size])
+            if predict_also_cloud_binary:
+                # expit(x) >= 0.5 <=> x >= 0
+                tile_votes[i : i + batch_size] = np.count_nonzero(curr_pred[:, :, 1] >= 0, axis=0)
+
+        # Average model predictions
+        tile_pred /= len(ensemble)
+        tile_pred = tile_pred.reshape(-1, W)
+        pred_map[r : r + tile_rows] = tile_pred
+
+        # Threshold the tile
+        if predict_also_cloud_binary:
+            pred_map_binary_list[0][r : r + tile_rows] = tile_votes.reshape(-1, W) >= 0.5 * len(ensemble)
+        else:
+            for thresh, pred_map_binary in zip(thresh_cloud, pred_map_binary_list):
+                np.greater_equal(tile_pred, thresh, out=pred_map_binary[r : r + tile_rows])
+        for thresh, pred_map_binary_thin in zip(thresh_thin_cloud, pred_map_binary_thin_list):
+            # Below: A thin cloud is a thin cloud only if it is above the thin thresh AND below the regular cloud thresh
+            np.logical_and(tile_pred >= thresh, tile_pred < thresh_cloud[0], out=pred_map_binary_thin[r : r + tile_rows])
+
+    if stats is not None:
+        stats['evaluations'] = H * W * len(ensemble) - nbr_skipped
+        stats['skipped_evaluations'] = nbr_skipped
+
+    # Potentially do post-processing on the cloud/not cloud (binary)
+    # prediction, so that it becomes more spatially coherent
+    pred_map_binary_list, pred_map_binary_thin_list = _mlp_post_filter(pred_map_binary_list, pred_map_binary_thin_list, pred_map, thresh_thin_cloud, post_filt_sz, post_filt_sliding)
+
+    # Return
+    return pred_map, pred_map_binary_list, pred_map_binary_thin_list
+
+def progressive_cloud_decision(img, means, stds, models, thresh_cloud, thresh_thin_cloud, frac_thres=5.0, z=3.29,
+                               first_sample_sz=1024, max_sample_sz=2**17, device='cpu', backend='torch', seed=0):
+    # Classify a growing random sample of pixels and stop as soon as a Wilson
+    # confidence interval (z=3.29 ~ 99.9%) on the cloudy fraction lies entirely
+    # above or below frac_thres (in percent). Returns (pred_cloudy, frac_estimate, nbr_sampled),
+    # where pred_cloudy is None if the sample cap was reached without a decision.
+    # NB: the post-filter is not applied to the sampled pixels
+    H, W, input_dim = img.shape
+    means = np.asarray(means, dtype=np.float32)
+    inv_stds = 1 / np.asarray(stds, dtype=np.float32)
+    ensemble = _get_ensemble(models, backend, device)
+
+    # A pixel counts as cloudy if it is either thick or thin cloud
+    thres = min(thresh_cloud[0], *thresh_thin_cloud)
+    p_thres = frac_thres / 100
+
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(H * W, size=min(max_sample_sz, H * W), replace=False)
+
+    nbr_cloudy, n = 0, 0
+    while n < len(sample):
+        idx = sample[n : max(first_sample_sz, 2 * n)]
+        pixels = np.subtract(img[idx // W, idx % W], means, dtype=np.float32)
+        pixels *= inv_stds
+        for i in range(0, len(idx), ENSEMBLE_BLOCK_SIZE):
+            pred = ensemble.predict(pixels[i : i + ENSEMBLE_BLOCK_SIZE])[:, :, 0].mean(axis=0)
+            nbr_cloudy += np.count_nonzero(pred >= thres)
+        n += len(idx)
+
+        p = nbr_cloudy / n
+        if n == H * W:
+            return p > p_thres, 100 * p, n
+
+        # Wilson score interval
+        center = (p + z**2 / (2 * n)) / (1 + z**2 / n)
+        half_width = z / (1 + z**2 / n) * np.sqrt(p * (1 - p) / n + z**2 / (4 * n**2))
+        if center - half_width > p_thres:
+            return True, 100 * p, n
+        if center + half_width < p_thres:
+            return False, 100 * p, n
+
+    return None, 100 * nbr_cloudy / max(n, 1), n
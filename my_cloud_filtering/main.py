@@ -1,32 +1,59 @@
 import os
 import time
-import datetime
 from shutil import copyfile
-import matplotlib.pyplot as plt
-import torch
 import numpy as np
 from skimage import measure
 import json
-from utils import mlp_inference, MLP5
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from inference import mlp_inference, load_ensemble, progressive_cloud_decision
+from bundle import load_bundle
+
+from band_cache import get_band_cache
+from get_data import get_data, get_products, get_scl_cloud_fraction, required_bands, normalize, PRODUCT_BANDS
+from writer import write_image, to_uint8
+from composite import Composite, clear_confidence, locked
+from timeseries import TimeSeriesStore
+from grid import date_range
 
-from get_data import get_data, get_product, normalize, plot
-
-from torch.cuda import is_available
 DEVICE = "cpu"#"cuda" if is_available else "cpu"
+INFERENCE_BACKEND = os.getenv("inference_backend", default="torch")  # "torch" or "numpy" (no torch import at all)
 DO_PLOT = True
+OUTPUT_FORMATS = ["png", "cog"]  # Formats of the saved products, see writer.py
 
 MLP_POST_FILTER_SZ = 1  # 1 --> no filtering, >= 2 --> majority vote within that-sized square
+MLP_POST_FILTER_SLIDING = False  # True --> vote over overlapping squares at every offset instead of a fixed grid
+CLOUD_FRAC_THRES = 5.0  # A scene is cloudy if more than this percentage of its pixels are (thin) cloud
+SCL_PRESCREEN_MARGIN = 20.0  # L2A: skip scenes whose SCL cloud/shadow fraction exceeds CLOUD_FRAC_THRES by this much, None --> always run the model
+OUTPUT_PRODUCTS = ["rgb"]  # Products made from the bands on top of the model input, see get_data.PRODUCT_BANDS
+SERVER_RESAMPLE_RESOLUTION = None  # e.g. 60 --> the backend resamples every band to this many meters, one download instead of one per resolution
+PROGRESSIVE_SAMPLING = False  # True --> first classify a growing pixel sample and skip scenes that are settled as cloudy
+MLP_ADAPTIVE_ENSEMBLE = False  # True --> only ambiguous pixels are evaluated by the whole ensemble
+MLP_MEM_BUDGET_MB = 256  # Inference streams the image in row-tiles that fit within this budget
+COMPOSITE_DIR = os.getenv("composite_dir", default="")  # e.g. ../outputs/composites --> keep a best-pixel composite per AOI, see composite.py
+TIMESERIES_DIR = os.getenv("timeseries_dir", default="")  # e.g. ../outputs/timeseries --> keep every inferred scene's COT map and cloud mask per AOI and model, see timeseries.py
+PREFETCH_SCENES = 2  # Batch mode: scenes downloaded ahead while the current one is inferred
+# The SCL pre-screen and progressive sampling drop scenes settled as cloudy before the model maps them,
+# so both are off while composite_dir or timeseries_dir is set: the clear part of an overcast scene still
+# fills in the composite, and the time series (and the queries of rethreshold.py) keep every day
+
+# Packed ensembles, see bundle.py (python3 bundle.py re-packs them from the checkpoints)
+BUNDLE_PATH = "../models/{}_ensemble.bundle"
+
+# Process-level model cache, so repeated predictions never reload the ensemble
+_MODEL_CACHE = {}
+_MODEL_DIGESTS = {}  # Source --> digest of the loaded bundle, None for the original checkpoints
 
 # Computed at training
 def mean_std_11c():
-	means = torch.Tensor(np.array([0.49675034, 0.47293043, 0.564903, 0.52927473, 0.65845986, 0.93623101, 0.90515048, 0.99451205, 0.45604575, 0.07375108, 0.53309616, 0.43224668])).to(DEVICE)
-	stds = torch.Tensor(np.array([0.28274442, 0.27778134, 0.28483809, 0.31573642, 0.28173209, 0.31942519, 0.32981911, 0.36159493, 0.29364748, 0.1140917,  0.41934613, 0.3335538])).to(DEVICE)
+	means = np.array([0.49675034, 0.47293043, 0.564903, 0.52927473, 0.65845986, 0.93623101, 0.90515048, 0.99451205, 0.45604575, 0.07375108, 0.53309616, 0.43224668], dtype=np.float32)
+	stds = np.array([0.28274442, 0.27778134, 0.28483809, 0.31573642, 0.28173209, 0.31942519, 0.32981911, 0.36159493, 0.29364748, 0.1140917,  0.41934613, 0.3335538], dtype=np.float32)
 	return means, stds
 
 # Computed at training
 def mean_std_12a():
-	means = torch.Tensor(np.array([0.64984976, 0.4967399, 0.47297233, 0.56489476, 0.52922534, 0.65842892, 0.93619591, 0.90525398, 0.99455938, 0.45607598, 0.07375734, 0.53310641, 0.43227456])).to(DEVICE)
-	stds = torch.Tensor(np.array([0.3596485, 0.28320853, 0.27819884, 0.28527526, 0.31613214, 0.28244289, 0.32065759, 0.33095272, 0.36282185, 0.29398295, 0.11411958, 0.41964159, 0.33375454])).to(DEVICE)
+	means = np.array([0.64984976, 0.4967399, 0.47297233, 0.56489476, 0.52922534, 0.65842892, 0.93619591, 0.90525398, 0.99455938, 0.45607598, 0.07375734, 0.53310641, 0.43227456], dtype=np.float32)
+	stds = np.array([0.3596485, 0.28320853, 0.27819884, 0.28527526, 0.31613214, 0.28244289, 0.32065759, 0.33095272, 0.36282185, 0.29398295, 0.11411958, 0.41964159, 0.33375454], dtype=np.float32)
 	return means, stds
 
 def init_l1c():
@@ -67,100 +94,293 @@ def init(source:str = "l1c") -> tuple:
 	if not os.path.exists(dir):
 		os.makedirs(dir)
 
-    # get params
-	if source == "l1c":
-		input_dim, paths, bands, means, stds, cloud_thres, thin_cloud_thres, collection  =  init_l1c()
+	source = "l1c" if source == "l1c" else "l2a"
+	if source in _MODEL_CACHE:
+		return _MODEL_CACHE[source]
+
+	# get params and models, preferably from the packed bundle
+	bundle_path = BUNDLE_PATH.format(source)
+	if os.path.exists(bundle_path):
+		bundle = load_bundle(bundle_path)
+		models = load_ensemble(bundle, INFERENCE_BACKEND, DEVICE)
+		means, stds = bundle.means, bundle.stds
+		bands, cloud_thres, thin_cloud_thres, collection = bundle.bands, bundle.cloud_thres, bundle.thin_cloud_thres, bundle.collection
+		_MODEL_DIGESTS[source] = bundle.digest
 	else:
-		input_dim, paths, bands, means, stds, cloud_thres, thin_cloud_thres, collection  = init_l2a()
-
-	# get models
-	paths = ["../"+path for path in paths]
-	models = []
-	for model_load_path in paths:
-		model = MLP5(input_dim, 1, apply_relu=True)
-		model.load_state_dict(torch.load(model_load_path, map_location=DEVICE))
-		model.to(DEVICE)
-		models.append(model)
-
-	return bands, models, means, stds, cloud_thres, thin_cloud_thres, collection
-
-def run_cloud_prediction(date: str = "2022-01-01", data_source:str = "l1c", params: dict = None):
-
-	# Get bands, models, etc. based on the data sources
+		if source == "l1c":
+			input_dim, paths, bands, means, stds, cloud_thres, thin_cloud_thres, collection  =  init_l1c()
+		else:
+			input_dim, paths, bands, means, stds, cloud_thres, thin_cloud_thres, collection  = init_l2a()
+
+		# get models
+		import torch
+		from model import MLP5, MLP5Ensemble
+		from inference import NumpyEnsemble
+		paths = ["../"+path for path in paths]
+		models = []
+		for model_load_path in paths:
+			model = MLP5(input_dim, 1, apply_relu=True)
+			model.load_state_dict(torch.load(model_load_path, map_location=DEVICE))
+			model.to(DEVICE)
+			models.append(model)
+		_MODEL_DIGESTS[source] = None
+		models = NumpyEnsemble.from_models(models) if INFERENCE_BACKEND == "numpy" else MLP5Ensemble.from_models(models)
+
+	_MODEL_CACHE[source] = bands, models, means, stds, cloud_thres, thin_cloud_thres, collection
+	return _MODEL_CACHE[source]
+
+def model_tag(source: str = "l1c") -> str:
+	# Short name of the loaded models, so that cached predictions of different models never mix
+	init(source)
+	digest = _MODEL_DIGESTS["l1c" if source == "l1c" else "l2a"]
+	return digest[:12] if digest else "checkpoints"
+
+def predict_clouds(img: np.ndarray, data_source: str = "l1c", offset: float = 0, scale: float = 1) -> tuple:
+	# (H, W, bands) model input --> pred_cloudy, cloud percentage, COT map and cloud (thick or thin) mask.
+	# The maps are None if progressive sampling already settled the scene as cloudy (see skips_cloudy_scenes).
+	# img can be raw digital numbers, reflectance = (img - offset) * scale
 	bands, models, means, stds, cloud_thres, thin_cloud_thres, _ = init(data_source)
-
-	# Get data
-	data = get_data(source=data_source, date=date, params=params)
-	if data == None:
-		return
-
-	img = get_product(data, bands, scaling="downsizing")
-
-	rgb_band_list = ["B09", "B04", "B03", "B02"]
-	RGB = normalize(get_product(data, rgb_band_list, scaling="downsizing"))[1:]
-
-	del data
-
-	img = np.transpose(img, (1, 2, 0))
-	RGB = np.transpose(RGB, (1, 2, 0))
-
-	# Extract image shape
 	H, W = img.shape[:2]
 
+	# Fold the radiometric offset/scale into the input normalization, which then is the
+	# only (float32) pass over the pixels: ((DN - offset) * scale - mean) / std == (DN - means) / stds
+	means, stds = offset + means / scale, stds / scale
+
 	THRESHOLD_THICKNESS_IS_CLOUD = [cloud_thres] # 0.010  # if COT predicted above this, then predicted as 'opaque cloud' ("thick" cloud)
 	THRESHOLD_THICKNESS_IS_THIN_CLOUD = [thin_cloud_thres] #0.010  # if COT predicted above this, then predicted as 'thin cloud' <-- set to the same as the opaque cloud threshold by default, i.e. it becomes a binary task (cloudy / clear) instead
+
+	# Scenes that a pixel sample already settles as cloudy are never saved, so skip full inference for them
+	if PROGRESSIVE_SAMPLING and skips_cloudy_scenes():
+		sampled_cloudy, sampled_frac, nbr_sampled = progressive_cloud_decision(img, means, stds, models,
+																				THRESHOLD_THICKNESS_IS_CLOUD,
+																				THRESHOLD_THICKNESS_IS_THIN_CLOUD,
+																				CLOUD_FRAC_THRES,
+																				device=DEVICE,
+																				backend=INFERENCE_BACKEND)
+		if sampled_cloudy:
+			print(f"Cloudy from {nbr_sampled} sampled pixels ({sampled_frac:.1f} prct)")
+			return True, sampled_frac, None, None
+
+	inference_stats = {}
 	pred_map, pred_map_binary_list, pred_map_binary_thin_list = mlp_inference(img, means, stds, models, H*W,
 																				THRESHOLD_THICKNESS_IS_CLOUD,
 																				THRESHOLD_THICKNESS_IS_THIN_CLOUD,
 																				MLP_POST_FILTER_SZ, 
-																				DEVICE)
+																				DEVICE,
+																				mem_budget_mb=MLP_MEM_BUDGET_MB,
+																				backend=INFERENCE_BACKEND,
+																				post_filt_sliding=MLP_POST_FILTER_SLIDING,
+																				adaptive=MLP_ADAPTIVE_ENSEMBLE,
+																				stats=inference_stats)
+	if MLP_ADAPTIVE_ENSEMBLE:
+		print("Skipped pixel-model evaluations:", inference_stats["skipped_evaluations"], "of", H*W*len(models))
 
 	# Track stats
 	pred_map_binary = pred_map_binary_list[0]
 	pred_map_binary_thin = pred_map_binary_thin_list[0]
 	frac_binary = 100*np.count_nonzero(pred_map_binary + pred_map_binary_thin) / H / W
-	pred_cloudy = frac_binary > 5.0
-
-	# Visualize results     
-	fig = plt.figure(figsize=(16, 16))
-
-	# fig.add_subplot(1,4,1)
-	plt.imshow(RGB, vmin=0, vmax=1)
-	# plt.title(f'image, {"Cloudy" if pred_cloudy else "Not cloudy"}')
-	plt.axis('off')
-
-	# fig.add_subplot(1,4,2)
-	# plt.imshow(RGB, vmin=0, vmax=1)
-	# if True: #SHOW_CLOUD_CONTOUR_ON_IMG:
-	# 	contours = measure.find_contours(0.0 + pred_map_binary + pred_map_binary_thin)#, 0.9)
-	# 	for contours_entry in contours:
-	# 		plt.plot(contours_entry[:, 1], contours_entry[:, 0], color='r')
-	# plt.title('image w contours')
-	# plt.axis('off')
-	
-	# fig.add_subplot(1,4,3)
-	# plt.title('pred (min, max)=(%.3f, %.3f)' % (np.nanmin(pred_map), np.nanmax(pred_map)))
-	# pred_map[np.isnan(pred_map)] = 0
-	# plt.imshow(pred_map, vmin=0, vmax=1, cmap='gray')
-	# plt.axis('off')
-
-	# fig.add_subplot(1,4,4)
-	# plt.imshow(0.0 + 2*pred_map_binary + pred_map_binary_thin, vmin=0, vmax=2, cmap='gray')
-	# plt.title('pred-binary, cloudy (%.1f prct)' % frac_binary)
-	# plt.axis('off')
-
-	# print("Cloudy:", bool(pred_cloudy))
-	if pred_cloudy == False:
-		save_path = f"../outputs/RBG_{date}_{data_source}"
-		print("saving: ", save_path)
-		plt.savefig(save_path)
+	pred_cloudy = frac_binary > CLOUD_FRAC_THRES
+
+	return pred_cloudy, frac_binary, pred_map, np.logical_or(pred_map_binary, pred_map_binary_thin)
+
+def make_params(date: str, data_source: str, coords: dict) -> dict:
+	# Setup json config for the openeo api
+	return {
+		"geojson": { 
+			"time": {
+				"date": date,
+			},
+			"geometry": { 
+				"type": "Box",
+    			"coords": coords
+			},
+			"collection": data_source,
+			}
+	}
+
+def fetch_scene(date: str = "2022-01-01", data_source: str = "l1c", params: dict = None) -> tuple:
+	# Download step of run_cloud_prediction --> (data, scl_frac). data is None if there is no data,
+	# or if the scene classification alone settled the scene as cloudy, see scl_settles_cloudy.
+	# scl_frac is None if there was no pre-screening
+	bands = init(data_source)[0]
+
+	# Only request what the model and the output products use
+	if params:
+		params = {"geojson": {**params["geojson"], "bands": required_bands(bands, OUTPUT_PRODUCTS)}}
+		if SERVER_RESAMPLE_RESOLUTION:
+			params["geojson"]["resolution"] = SERVER_RESAMPLE_RESOLUTION
+
+	# Cheap first pass: the scene classification alone settles clearly overcast scenes,
+	# so they are never downloaded in full or run through the model
+	scl_frac = None
+	if data_source == "l2a" and params and SCL_PRESCREEN_MARGIN is not None and skips_cloudy_scenes():
+		scl_frac = get_scl_cloud_fraction(params)
+		if scl_settles_cloudy(scl_frac):
+			return None, scl_frac
+
+	# Get data
+	return get_data(source=data_source, date=date, params=params), scl_frac
+
+def skips_cloudy_scenes() -> bool:
+	# Scenes settled as cloudy may only be skipped if the composite and time series don't need their maps
+	return not (COMPOSITE_DIR or TIMESERIES_DIR)
+
+def scl_settles_cloudy(scl_frac: float) -> bool:
+	return scl_frac is not None and scl_frac > CLOUD_FRAC_THRES + SCL_PRESCREEN_MARGIN
 
-	# plt.cla()
-	# plt.clf()
-	# plt.close('all')
+def run_cloud_prediction(date: str = "2022-01-01", data_source:str = "l1c", params: dict = None,
+						 fetched: tuple = None, output_tag: str = "", stats: dict = None):
+	# fetched: fetch_scene's result, if the data was already downloaded (e.g. prefetched)
+	# output_tag: appended to the names of the saved products
+	# stats (dict): filled with the scene's cloud percentages
+
+	# Get bands, models, etc. based on the data sources
+	bands, models, means, stds, cloud_thres, thin_cloud_thres, _ = init(data_source)
+
+	# Get data
+	data, scl_frac = fetch_scene(date, data_source, params) if fetched is None else fetched
+	if stats is not None:
+		stats["scl_frac"] = scl_frac
+	if data == None:
+		if not scl_settles_cloudy(scl_frac):
+			return
+		print(f"Cloudy from the scene classification ({scl_frac:.1f} prct)")
+		return True, None
+
+	# Model input and output products are views of one stack, every band is resampled once
+	products = get_products(data, {"model": bands, **{product: PRODUCT_BANDS[product] for product in OUTPUT_PRODUCTS}},
+							scaling="downsizing")
+	offset, scale = data.offset, data.scale
+	transform, crs = data.grid_transform(products["model"].shape[1:]), data.crs
+	del data
+
+	img = np.transpose(products["model"], (1, 2, 0))
+	pred_cloudy, frac_binary, pred_map, cloud_mask = predict_clouds(img, data_source, offset, scale)
+	if stats is not None:
+		stats["cloud_frac"] = float(frac_binary)
+
+	# Partially clear scenes still fill in the composite, before RGB is stretched in place
+	if COMPOSITE_DIR and pred_map is not None:
+		changed = update_composite(date, data_source, params, products["rgb"], cloud_mask, pred_map, thin_cloud_thres, offset,
+								   transform, crs)
+		if stats is not None:
+			stats["composite_changed"] = int(changed.size)
+
+	# Every inferred scene, cloudy or not, goes into the AOI's time series
+	if TIMESERIES_DIR and pred_map is not None:
+		append_timeseries(date, data_source, params, pred_map, cloud_mask, transform, crs,
+						  {"bundle": model_tag(data_source), "cloud_thres": cloud_thres, "thin_cloud_thres": thin_cloud_thres,
+						   "cloud_frac": float(frac_binary), "post_filter_sz": MLP_POST_FILTER_SZ, "post_filter_sliding": MLP_POST_FILTER_SLIDING})
+
+	# Stretched in place, so only once the model is done with the stack
+	RGB = np.transpose(normalize(products["rgb"]), (1, 2, 0))
+	if pred_map is None:
+		return pred_cloudy, RGB
+
+	# Save the cloud-free products, georeferenced by the scene's grid
+	if pred_cloudy == False:
+		for name, image in [("RBG", to_uint8(RGB)), ("cloudmask", cloud_mask)]:
+			for save_path in write_image(f"../outputs/{name}_{date}_{data_source}{output_tag}", image, OUTPUT_FORMATS, transform, crs):
+				print("saving: ", save_path)
 
 	return pred_cloudy, RGB
 
+def aoi_key(data_source: str, params: dict) -> str:
+	# Name of an AOI and source in the composites and time series, from the AOI's coordinates
+	coords = json.dumps(params["geojson"]["geometry"]["coords"] if params else None, sort_keys=True)
+	return f"{data_source}_{hashlib.sha1(coords.encode()).hexdigest()[:12]}"
+
+def update_composite(date: str, data_source: str, params: dict, bands: np.ndarray, cloud_mask: np.ndarray,
+					 pred_map: np.ndarray, thin_cloud_thres: float, offset: float, transform: tuple = None,
+					 crs: str = None) -> np.ndarray:
+	# One composite per AOI and source, its map saved as ../outputs/composite_{aoi_key}. Returns the changed pixels.
+	# Locked, as other jobs may be updating the same AOI with other dates
+	key = aoi_key(data_source, params)
+	path = os.path.join(COMPOSITE_DIR, key)
+	valid = np.all(bands > 0, axis=0)  # DN 0 is no data
+	confidence = clear_confidence(pred_map, thin_cloud_thres)
+	with locked(path):
+		composite = Composite.open_or_create(path, bands.shape[1:], PRODUCT_BANDS["rgb"], offset)
+		if composite.shape != bands.shape[1:]:
+			print(f"Composite {path} is {composite.shape}, the scene {bands.shape[1:]}: not updated")
+			return np.empty(0, dtype=np.int64)
+
+		changed = composite.update(date, bands, cloud_mask, confidence, valid, offset)
+		composite.flush()
+		coverage = composite.coverage()
+
+		# Today's map: only the changed pixels are stretched, then the map is saved whole
+		image = composite.paint(composite.open_map(), changed)
+		image.flush()
+		for save_path in write_image(f"../outputs/composite_{key}", np.transpose(image, (1, 2, 0)), OUTPUT_FORMATS, transform, crs):
+			print("saving: ", save_path)
+		del composite, image
+	print(f"Composite: {changed.size} pixels updated, {coverage:.1f} prct seen clear")
+	return changed
+
+def append_timeseries(date: str, data_source: str, params: dict, pred_map: np.ndarray, cloud_mask: np.ndarray,
+					  transform: tuple, crs: str, attrs: dict) -> bool:
+	# Store the scene's COT map (float16) and cloud mask (bit-packed) as a date of the AOI's time series.
+	# One series per AOI and model, see rethreshold.py for re-thresholding the cached COT maps.
+	# Safe with other jobs appending other dates of the same AOI
+	store = TimeSeriesStore(TIMESERIES_DIR)
+	tile = f"{aoi_key(data_source, params)}_{model_tag(data_source)}"
+	meta = store.meta(tile)
+	if meta is not None and tuple(meta["shape"]) != pred_map.shape:
+		print(f"Time series {tile} is {tuple(meta['shape'])}, the scene {pred_map.shape}: not appended")
+		return False
+	store.append(tile, date, {"cot": pred_map, "cloud_mask": cloud_mask}, attrs, transform, crs)
+	return True
+
+def run_batch(dates: list, data_source: str, aois: list, prefetch: int = PREFETCH_SCENES, aoi_names: list = None) -> list:
+	# Cloud prediction for every (date, AOI) in one process: the models and the openEO session
+	# stay warm, and the downloads of the next scenes run while the current one is inferred.
+	# aoi_names: used in the names of the saved products, by default the AOIs' indices.
+	# Returns one summary row per scene, with the band cache's hits and misses so far
+	if aoi_names is None:
+		aoi_names = [f"aoi{i}" for i in range(len(aois))] if len(aois) > 1 else [""]
+	jobs = [(date, i, coords) for date in dates for i, coords in enumerate(aois)]
+	summary = []
+	cache = get_band_cache()
+
+	# Load the models before the download threads need them
+	init(data_source)
+	with ThreadPoolExecutor(max_workers=max(1, prefetch)) as executor:
+		fetches = {}
+		for n, (date, i, coords) in enumerate(jobs):
+			# Keep the download queue prefetch scenes ahead
+			for m in range(n, min(n + prefetch + 1, len(jobs))):
+				if m not in fetches:
+					fetches[m] = executor.submit(fetch_scene, jobs[m][0], data_source, make_params(jobs[m][0], data_source, jobs[m][2]))
+
+			start_time = time.time()
+			stats = {}
+			try:
+				result = run_cloud_prediction(date, data_source, make_params(date, data_source, coords), fetched=fetches.pop(n).result(),
+											  output_tag=f"_{aoi_names[i]}" if aoi_names[i] else "", stats=stats)
+				status = "no data" if result is None else "cloudy" if result[0] else "clear"
+			except Exception as e:
+				print(f"{date} aoi {aoi_names[i] or i} failed:", e)
+				status = "failed"
+
+			summary.append({"date": date, "aoi": aoi_names[i] or i, "status": status, "cloud_frac": stats.get("cloud_frac"),
+							"scl_frac": stats.get("scl_frac"), "composite_changed": stats.get("composite_changed"),
+							"seconds": round(time.time() - start_time, 2),
+							**{f"cache_{name}": count for name, count in (cache.stats() if cache is not None else {}).items()}})
+			print(summary[-1])
+
+	return summary
+
+def summary_tag(aoi_names: list) -> str:
+	# Jobs of one date block differ in their (consecutive) tiles, so their summaries are named by the first and last
+	names = [name for name in aoi_names or [] if name]
+	return "" if not names else f"_{names[0]}" if len(names) == 1 else f"_{names[0]}-{names[-1]}"
+
+def save_summary(save_path: str, summary: list) -> str:
+	with open(save_path, "w") as f:
+		json.dump(summary, f, indent=1, default=float)
+	return save_path
+
 def analysis(RGB):
     # Do something with the RGB data.
 
@@ -170,32 +390,22 @@ def analysis(RGB):
 
 if __name__ == "__main__":
     
-    # Get env params
+    # Get env params. coords is one AOI or a list of them (aoi_names optionally names them),
+    # start_date/end_date (inclusive) a date range
 	json_coords = os.getenv("coords", default="{\"east\": 14.79187736312752, \"south\": 55.991257253340635, \"west\": 14.555719745816692, \"north\": 56.10331290101734}")
 	coords = json.loads(json_coords)
-	date = os.getenv("date", default="2022-01-01")
+	aois = coords if isinstance(coords, list) else [coords]
+	aoi_names = json.loads(os.getenv("aoi_names", default="null"))
+	start_date = os.getenv("start_date", default=os.getenv("date", default="2022-01-01"))
+	end_date = os.getenv("end_date", default=start_date)
 	data_source = os.getenv("data_source", default="l2a")
-	print(date, data_source, coords)
+	print(start_date, end_date, data_source, aois)
 
 	start_time = time.time()
 
-	# Setup json config for the openeo api
-	params = {
-		"geojson": { 
-			"time": {
-				"date": date,
-			},
-			"geometry": { 
-				"type": "Box",
-    			"coords": coords
-			},
-			"collection": data_source,
-			"bands": ["B01", "B02", "B03", "B04", "B05", "B06", "B07", "B08", "B8A", "B09", "B10", "B11", "B12", "scl"]
-			}
-	}
-
 	# Run cloud prediction
-	pred_cloudy, RGB = run_cloud_prediction(date=date, data_source=data_source, params=params)
+	summary = run_batch(date_range(start_date, end_date), data_source, aois, aoi_names=aoi_names)
+	print("saving: ", save_summary(f"../outputs/summary_{start_date}_{end_date}_{data_source}{summary_tag(aoi_names)}.json", summary))
 
 	# Run analysis if no cloud was found
 	# if pred_cloudy:
@@ -1,4 +1,91 @@
-# from utils import MLP5
+import torch
+import torch.nn as nn
+
+# The models only, so that inference and the workers never import the training
+# and plotting dependencies of utils.py
+
+# Simple 5-layer MLP model
+class MLP5(nn.Module):
+	def __init__(self, input_dim, output_dim=1, hidden_dim=64, apply_relu=True):
+		super(MLP5, self).__init__()
+		self.lin1 = nn.Linear(input_dim, hidden_dim)
+		self.lin2 = nn.Linear(hidden_dim, hidden_dim)
+		self.lin3 = nn.Linear(hidden_dim, hidden_dim)
+		self.lin4 = nn.Linear(hidden_dim, hidden_dim)
+		self.lin5 = nn.Linear(hidden_dim, output_dim)
+		self.relu = nn.ReLU()
+		self.apply_relu = apply_relu
+
+	def forward(self, x):
+		x1 = self.lin1(x)
+		x1 = self.relu(x1)
+		x2 = self.lin2(x1)
+		x2 = self.relu(x2)
+		x3 = self.lin3(x2)
+		x3 = self.relu(x3)
+		x4 = self.lin4(x3)
+		x4 = self.relu(x4)
+		x5 = self.lin5(x4)
+		if self.apply_relu:
+			x5[:, 0] = self.relu(x5[:, 0])  # NB: cloud optical thicknesses cannot be negative
+		return x5
+
+class MLP5Ensemble():
+	"""
+	Ensemble of MLP5 models with the weights of all members stacked into
+	batched tensors, so that every member is evaluated in one bmm-pass
+	"""
+	LAYERS = ['lin1', 'lin2', 'lin3', 'lin4', 'lin5']
+
+	def __init__(self, weights, biases, apply_relu=True):
+		# Weights are stored transposed, (nbr_models, in_dim, out_dim), and biases
+		# as (nbr_models, 1, out_dim) so that they broadcast over the batch
+		self.weights = weights
+		self.biases = biases
+		self.apply_relu = apply_relu
+		self.device = weights[0].device
+
+	@classmethod
+	def from_models(cls, models):
+		weights = [torch.stack([getattr(model, layer).weight.detach().t() for model in models]).contiguous() for layer in cls.LAYERS]
+		biases = [torch.stack([getattr(model, layer).bias.detach() for model in models]).unsqueeze(1) for layer in cls.LAYERS]
+		return cls(weights, biases, models[0].apply_relu)
+
+	@classmethod
+	def from_bundle(cls, bundle):
+		# Shares memory with the (memory mapped) bundle arrays
+		weights = [torch.from_numpy(weight) for weight in bundle.weights()]
+		biases = [torch.from_numpy(bias) for bias in bundle.biases()]
+		return cls(weights, biases, bundle.apply_relu)
+
+	def __len__(self):
+		return self.weights[0].shape[0]
+
+	def to(self, device):
+		self.weights = [weight.to(device) for weight in self.weights]
+		self.biases = [bias.to(device) for bias in self.biases]
+		self.device = torch.device(device)
+		return self
+
+	def predict(self, x, members=slice(None)):
+		# NumPy in and out, same interface as inference.NumpyEnsemble
+		return self(torch.from_numpy(x).to(self.device), members).cpu().numpy()
+
+	@torch.no_grad()
+	def __call__(self, x, members=slice(None)):
+		# x: (N, input_dim) --> (nbr_models, N, output_dim), optionally only for
+		# a slice of the ensemble members
+		weights = [weight[members] for weight in self.weights]
+		biases = [bias[members] for bias in self.biases]
+		x = x.unsqueeze(0).expand(weights[0].shape[0], -1, -1)
+		for weight, bias in zip(weights[:-1], biases[:-1]):
+			x = torch.baddbmm(bias, x, weight).relu_()
+		x = torch.baddbmm(biases[-1], x, weights[-1])
+		if self.apply_relu:
+			x[:, :, 0].relu_()  # NB: cloud optical thicknesses cannot be negative
+		return x
+
+
 # def l1c_models_paths():
 #     ['../log/2023-08-10_10-33-44/model_it_2000000', '../log/2023-08-10_10-34-06/model_it_2000000', '../log/2023-08-10_10-34-18/model_it_2000000',
 # 				   '../log/2023-08-10_10-34-28/model_it_2000000', '../log/2023-08-10_10-34-46/model_it_2000000', '../log/2023-08-10_10-34-58/model_it_2000000',
@@ -0,0 +1,136 @@
+import numpy as np
+
+# Resampling of whole band stacks onto one grid, in float32.
+# Integer ratios (e.g. 10 m -> 20 m -> 60 m) are exact block means, every other
+# ratio goes through a separable kernel applied one axis at a time.
+
+# Kernels: (function of the distance in source pixels, support radius)
+KERNELS = {
+    "lanczos": (lambda t: np.sinc(t) * np.sinc(t / 3), 3.0),
+    "bilinear": (lambda t: np.maximum(1 - np.abs(t), 0), 1.0),
+    "box": (lambda t: ((t >= -0.5) & (t < 0.5)).astype(np.float64), 0.5),
+}
+
+
+def kernel_taps(n_in: int, n_out: int, kernel: str = "lanczos") -> tuple:
+    # Resampling weights along one axis as (n_out, taps) source indices and weights.
+    # Like PIL, the kernel is stretched by the scale factor when downsampling, so it
+    # also anti-aliases. Source indices outside the image are clamped to its edge
+    func, support = KERNELS[kernel]
+    scale = n_in / n_out
+    filter_scale = max(scale, 1.0)
+    radius = support * filter_scale
+
+    centers = (np.arange(n_out) + 0.5) * scale
+    # Source pixel j is within reach if |j + 0.5 - center| < radius
+    first = np.floor(centers - 0.5 - radius).astype(np.int64) + 1
+    taps = int(np.ceil(2 * radius))
+    indices = first[:, np.newaxis] + np.arange(taps)
+
+    dist = (indices + 0.5 - centers[:, np.newaxis]) / filter_scale
+    inside = (np.abs(dist) < support) & (indices >= 0) & (indices < n_in)
+    weights = np.where(inside, func(dist), 0.0)
+    weights /= weights.sum(axis=1, keepdims=True)
+    return np.clip(indices, 0, n_in - 1), weights.astype(np.float32)
+
+
+def _apply_taps(src: np.ndarray, axis: int, indices: np.ndarray, weights: np.ndarray) -> np.ndarray:
+    # Weighted sum of shifted gathers along axis, one pass per tap
+    shape = [1] * src.ndim
+    shape[axis] = -1
+    out = None
+    for k in range(indices.shape[1]):
+        term = np.take(src, indices[:, k], axis=axis, mode="clip")
+        term *= weights[:, k].reshape(shape)
+        if out is None:
+            out = term
+        else:
+            out += term
+    return out
+
+
+def _block_factor(n_in: int, n_out: int) -> int:
+    # Integer downsampling factor, allowing the edge to be off by less than one
+    # output pixel (AOIs rarely cover a whole number of 60 m pixels), else None
+    factor = round(n_in / n_out)
+    if factor >= 2 and abs(n_in - n_out * factor) < factor:
+        return factor
+    return None
+
+
+def _index(ndim: int, axis: int, index) -> tuple:
+    # Index that applies to one axis only
+    full = [slice(None)] * ndim
+    full[axis] = index
+    return tuple(full)
+
+
+def _block_sum(src: np.ndarray, axis: int, size: int, factor: int) -> np.ndarray:
+    # Sums of runs of factor elements along axis, as factor strided adds. If src is
+    # short of size * factor elements, its last element stands in for the missing ones
+    n = src.shape[axis]
+    out = None
+    for k in range(factor):
+        part = src[_index(src.ndim, axis, slice(k, min(n, size * factor), factor))]
+        if out is None:
+            out = part.astype(np.float32)
+        else:
+            out[_index(src.ndim, axis, slice(0, part.shape[axis]))] += part
+        if part.shape[axis] < size:
+            out[_index(src.ndim, axis, slice(part.shape[axis], size))] += src[_index(src.ndim, axis, slice(n - 1, n))]
+    return out
+
+
+def block_mean(src: np.ndarray, shape: tuple, fy: int, fx: int, out: np.ndarray = None) -> np.ndarray:
+    # (..., h, w) --> (..., H, W) means over fy x fx blocks
+    cols = _block_sum(src, src.ndim - 1, shape[1], fx)
+    block = _block_sum(cols, src.ndim - 2, shape[0], fy)
+    return np.multiply(block, 1 / (fy * fx), out=out)
+
+
+def resample_group(src: np.ndarray, shape: tuple, kernel: str = "lanczos") -> np.ndarray:
+    # (n, h, w) float32 stack of same-sized bands --> (n, H, W)
+    h, w = src.shape[1:]
+    if (h, w) == tuple(shape):
+        return src
+
+    fy, fx = _block_factor(h, shape[0]), _block_factor(w, shape[1])
+    if fy and fx:
+        return block_mean(src, shape, fy, fx)
+
+    # Separable kernel: along the rows, then along the columns
+    src = _apply_taps(src, 2, *kernel_taps(w, shape[1], kernel))
+    return _apply_taps(src, 1, *kernel_taps(h, shape[0], kernel))
+
+
+def resample_stack(bands: list, shape: tuple, kernel: str = "lanczos", out: np.ndarray = None) -> np.ndarray:
+    # 2D bands of any sizes --> (bands, H, W) float32 stack. Bands of the same size
+    # are resampled together and written straight into out, which can be preallocated
+    shape = tuple(shape)
+    if out is None:
+        out = np.empty((len(bands),) + shape, dtype=np.float32)
+
+    groups = {}
+    for i, band in enumerate(bands):
+        groups.setdefault(band.shape, []).append(i)
+
+    for band_shape, indices in groups.items():
+        if band_shape == shape:
+            for i in indices:
+                out[i] = bands[i]
+            continue
+
+        # Block means are computed band by band straight from the source arrays, which
+        # spares stacking (and converting) the finest bands before they are reduced
+        fy, fx = _block_factor(band_shape[0], shape[0]), _block_factor(band_shape[1], shape[1])
+        if fy and fx:
+            for i in indices:
+                block_mean(bands[i], shape, fy, fx, out=out[i])
+            continue
+
+        src = np.stack([bands[i] for i in indices]).astype(np.float32, copy=False)
+        resampled = resample_group(src, shape, kernel)
+        for j, i in enumerate(indices):
+            out[i] = resampled[j]
+
+    return out
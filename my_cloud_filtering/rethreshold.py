@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+Re-threshold cached COT maps: cloud masks, cloud fractions and clear/cloudy decisions
+for any thresholds, without downloading or inferring the scenes again.
+
+The COT maps are the ones main.py keeps per AOI and model with timeseries_dir set,
+see timeseries.py.
+
+    python3 rethreshold.py ../outputs/timeseries --cloud-thres 0.01 0.02 0.03 --thin-cloud-thres 0.005 0.01 --frac-thres 5 10
+"""
+import argparse
+import itertools
+import json
+import numpy as np
+
+from inference import _block_majority, _sliding_majority
+from timeseries import TimeSeriesStore
+
+# A float16 COT map is reduced to one count per float16 value. COT is clamped to >= 0
+# by the model's output ReLU, so only the non-negative values (0 to inf) are counted,
+# and the bit patterns of those sort like the values: the number of pixels at or above
+# any threshold is one lookup in the cumulative counts, for every scene and threshold at
+# once. Decisions are those of the float16 maps: a pixel within float16 rounding (~0.05 %)
+# of a threshold can land on the other side of it than in mlp_inference.
+
+NBR_KEYS = 0x7C00 + 1  # float16 bit patterns of 0 up to inf
+COUNTS_CACHE_MB = 1024  # CotQuery keeps the counts of the scenes that fit, and counts the others again per query
+
+KEY_VALUES = np.arange(NBR_KEYS, dtype=np.uint16).view(np.float16).astype(np.float32)
+
+
+def cumulative_counts(cot: np.ndarray) -> np.ndarray:
+    # COT map --> (NBR_KEYS + 1) counts of the pixels below each key. Negative (-0) and NaN
+    # values count as 0
+    cot = np.asarray(cot, dtype=np.float16)
+    keys = np.where(cot > 0, cot, np.float16(0)).view(np.uint16)
+    cumulative = np.zeros(NBR_KEYS + 1, dtype=np.int32)
+    np.cumsum(np.bincount(keys.ravel(), minlength=NBR_KEYS), out=cumulative[1:])
+    return cumulative
+
+
+def union_thres(cloud_thres, thin_cloud_thres) -> np.ndarray:
+    # A pixel is (thick or thin) cloud from the lower of its two thresholds on
+    return np.minimum(np.asarray(cloud_thres, dtype=np.float32), np.asarray(thin_cloud_thres, dtype=np.float32))
+
+
+def cloud_mask(cot: np.ndarray, cloud_thres: float, thin_cloud_thres: float, post_filt_sz: int = 1,
+               sliding: bool = False) -> np.ndarray:
+    # The (thick or thin) cloud mask mlp_inference makes with these thresholds, post filter included
+    cot = np.asarray(cot, dtype=np.float16)
+    if post_filt_sz == 1:
+        return cot >= union_thres(cloud_thres, thin_cloud_thres)
+
+    majority = _sliding_majority if sliding else _block_majority
+    thick = cot >= np.float32(cloud_thres)
+    thin = (cot >= np.float32(thin_cloud_thres)) & ~thick
+    return majority(thick, post_filt_sz) | majority(thin, post_filt_sz)
+
+
+class CotQuery():
+    """
+    Cached COT maps of many scenes (tiles x dates of a TimeSeriesStore), held as
+    per-scene cumulative counts to evaluate threshold sets over all scenes at once
+    """
+    def __init__(self, store: TimeSeriesStore, tiles: list = None, bundle: str = None,
+                 start_date: str = None, end_date: str = None, cache_mb: float = COUNTS_CACHE_MB):
+        # bundle: only scenes predicted by this model (main.model_tag), start_date/end_date: inclusive.
+        # The counts are made tile by tile when first needed, and kept up to cache_mb
+        self.store = store
+        self.scenes = []
+        self._tiles = []  # [(tile, dates), ...], in the order of the scenes
+        for tile in tiles or store.tiles():
+            dates = []
+            for date in store.dates(tile):
+                if (start_date and date < start_date) or (end_date and date > end_date):
+                    continue
+                record = store.record(tile, date)
+                if "cot" not in record["arrays"] or (bundle is not None and record["attrs"].get("bundle") != bundle):
+                    continue
+                dates.append(date)
+                self.scenes.append((tile, date))
+            if dates:
+                self._tiles.append((tile, dates))
+        self._counts = {}
+        self._cache_bytes = int(cache_mb * 2**20)
+
+    def __len__(self) -> int:
+        return len(self.scenes)
+
+    def _tile_counts(self):
+        # --> (slice of self.scenes, (scenes, NBR_KEYS + 1) cumulative counts) per tile
+        start = 0
+        for tile, dates in self._tiles:
+            counts = self._counts.get(tile)
+            if counts is None:
+                # Scene by scene, only the counts are kept
+                counts = np.stack([cumulative_counts(self.store.read(tile, "cot", [date])[0][0]) for date in dates])
+                if counts.nbytes <= self._cache_bytes:
+                    self._counts[tile] = counts
+                    self._cache_bytes -= counts.nbytes
+            yield slice(start, start + len(dates)), counts
+            start += len(dates)
+
+    def fractions(self, cloud_thres, thin_cloud_thres, post_filt_sz: int = 1, sliding: bool = False) -> np.ndarray:
+        # Cloud percentages (scenes, *thresholds' broadcast shape). Pass e.g. cloud_thres[:, None]
+        # and thin_cloud_thres[None, :] for every combination. A post filter needs the maps
+        # themselves, so then every scene is read and masked once per threshold pair
+        cloud_thres, thin_cloud_thres = np.broadcast_arrays(np.asarray(cloud_thres, dtype=np.float32),
+                                                            np.asarray(thin_cloud_thres, dtype=np.float32))
+        if post_filt_sz > 1:
+            return self._filtered_fractions(cloud_thres, thin_cloud_thres, post_filt_sz, sliding)
+
+        keys = np.searchsorted(KEY_VALUES, union_thres(cloud_thres, thin_cloud_thres), side="left")
+        out = np.empty((len(self),) + cloud_thres.shape)
+        for scenes, counts in self._tile_counts():
+            total = counts[:, -1].reshape((-1,) + (1,) * cloud_thres.ndim)
+            out[scenes] = 100 * (total - counts[:, keys]) / np.maximum(total, 1)
+        return out
+
+    def _filtered_fractions(self, cloud_thres, thin_cloud_thres, post_filt_sz, sliding) -> np.ndarray:
+        out = np.empty((len(self),) + cloud_thres.shape)
+        for n, (tile, date) in enumerate(self.scenes):
+            cot = self.store.read(tile, "cot", [date])[0][0]
+            for index in np.ndindex(cloud_thres.shape):
+                mask = cloud_mask(cot, cloud_thres[index], thin_cloud_thres[index], post_filt_sz, sliding)
+                out[(n,) + index] = 100 * np.count_nonzero(mask) / mask.size
+        return out
+
+    def decisions(self, cloud_thres, thin_cloud_thres, frac_thres, **filter_kwargs) -> np.ndarray:
+        # Cloudy (True) or clear per scene and threshold set, with an extra last axis for a list of frac_thres
+        return np.greater.outer(self.fractions(cloud_thres, thin_cloud_thres, **filter_kwargs), np.asarray(frac_thres))
+
+    def mask(self, tile: str, date: str, cloud_thres: float, thin_cloud_thres: float, window: tuple = None,
+             **filter_kwargs) -> np.ndarray:
+        # One scene's cloud mask with other thresholds (within the window, see TimeSeriesStore.read)
+        return cloud_mask(self.store.read(tile, "cot", [date], window)[0][0], cloud_thres, thin_cloud_thres, **filter_kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("root", help="time series store (timeseries_dir of main.py)")
+    parser.add_argument("--cloud-thres", type=float, nargs="+", required=True)
+    parser.add_argument("--thin-cloud-thres", type=float, nargs="+", default=None, help="default: the cloud thresholds")
+    parser.add_argument("--frac-thres", type=float, nargs="+", default=[5.0], help="cloudy above this percentage")
+    parser.add_argument("--tiles", nargs="+", default=None, help="default: every tile in the store")
+    parser.add_argument("--bundle", default=None, help="only scenes of this model (main.model_tag)")
+    parser.add_argument("--start-date", default=None)
+    parser.add_argument("--end-date", default=None)
+    parser.add_argument("--post-filter-sz", type=int, default=1)
+    parser.add_argument("--report", default=None, help="save the per-scene cloud percentages to this JSON file")
+    args = parser.parse_args()
+
+    query = CotQuery(TimeSeriesStore(args.root), args.tiles, args.bundle, args.start_date, args.end_date)
+    cloud_thres = np.array(args.cloud_thres)
+    thin_cloud_thres = np.array(args.thin_cloud_thres or args.cloud_thres)
+    fractions = query.fractions(cloud_thres[:, None], thin_cloud_thres[None, :], args.post_filter_sz)
+    cloudy = np.greater.outer(fractions, np.array(args.frac_thres))
+    print(f"{len(query)} scenes")
+
+    for (i, cloud), (j, thin), (k, frac) in itertools.product(enumerate(cloud_thres), enumerate(thin_cloud_thres),
+                                                              enumerate(args.frac_thres)):
+        print(f"cloud {cloud:g}, thin cloud {thin:g}, frac {frac:g}: {np.count_nonzero(~cloudy[:, i, j, k])} clear")
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump({"cloud_thres": args.cloud_thres, "thin_cloud_thres": thin_cloud_thres.tolist(),
+                       "scenes": [{"tile": tile, "date": date, "cloud_frac": fractions[n].tolist()}
+                                  for n, (tile, date) in enumerate(query.scenes)]}, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+import numpy as np
+
+# Sentinel-2 reflectances are stored as digital numbers: reflectance = (DN - offset) * scale
+DN_SCALE = 1 / 10000
+
+
+class Scene(dict):
+    """
+    Bands as raw digital numbers (band name --> uint16 array) plus the radiometric
+    offset/scale that turn them into reflectances and the georeferencing of the
+    finest band grid
+    """
+    def __init__(self, bands: dict = None, offset: float = 0, scale: float = DN_SCALE, transform: tuple = None, crs: str = None):
+        super().__init__(bands or {})
+        self.offset = offset
+        self.scale = scale
+        self.transform = tuple(transform)[:6] if transform is not None else None
+        self.crs = crs
+
+    def reflectance(self, band: str) -> np.ndarray:
+        # A single band converted to reflectance (a float32 copy)
+        out = np.subtract(self[band], self.offset, dtype=np.float32)
+        out *= self.scale
+        return out
+
+    def grid_transform(self, shape: tuple) -> tuple:
+        # Geotransform of the scene's extent resampled to a (H, W) grid
+        if self.transform is None:
+            return None
+        h, w = max(band.shape for band in self.values())
+        a, b, c, d, e, f = self.transform
+        return (a * w / shape[1], b, c, d, e * h / shape[0], f)
+
+    def meta(self) -> dict:
+        # JSON-serializable description of everything but the bands
+        return {"offset": self.offset, "scale": self.scale, "transform": self.transform, "crs": self.crs}
+
+    @classmethod
+    def from_meta(cls, bands: dict, meta: dict):
+        return cls(bands, **meta)
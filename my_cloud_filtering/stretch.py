@@ -0,0 +1,79 @@
+import numpy as np
+
+# Percentile contrast stretch of (channels, H, W) images. The percentiles of all
+# channels come from one histogram pass: exact for integer images (one bin per
+# value of the uint16 range), and within half a bin width for float images.
+# Parameters can be computed over several tiles at once, so a mosaic is
+# stretched the same everywhere.
+
+STRETCH_PERCENTILES = (2, 98)
+STRETCH_BINS = 4096  # Float images: bins between each channel's min and max
+UINT16_BINS = 2**16
+
+
+def _histograms(tiles: list, lo: np.ndarray, width: np.ndarray, bins: int) -> np.ndarray:
+    # (channels, bins) counts over all tiles, channel c binned from lo[c] in steps of width[c]
+    nbr_channels = tiles[0].shape[0]
+    counts = np.zeros(nbr_channels * bins, dtype=np.int64)
+    channel_offset = (np.arange(nbr_channels) * bins).reshape(-1, 1, 1)
+    for tile in tiles:
+        if np.issubdtype(tile.dtype, np.integer):
+            index = tile.astype(np.int64)
+        else:
+            index = np.subtract(tile, lo.reshape(-1, 1, 1), dtype=np.float32)
+            index /= width.reshape(-1, 1, 1)
+            index = np.clip(index, 0, bins - 1, out=index).astype(np.int64)
+        index += channel_offset
+        counts += np.bincount(index.ravel(), minlength=nbr_channels * bins)
+    return counts.reshape(nbr_channels, bins)
+
+
+def _ranked_bins(counts: np.ndarray, ranks: np.ndarray) -> np.ndarray:
+    # (channels, ranks) index of the bin holding each 0-based rank
+    cumulative = np.cumsum(counts, axis=1)
+    return np.stack([np.searchsorted(c, ranks, side="right") for c in cumulative])
+
+
+def stretch_params(tiles, percentiles: tuple = STRETCH_PERCENTILES, bins: int = STRETCH_BINS) -> tuple:
+    # (channels, H, W) image, or a list of them (e.g. the tiles of a mosaic) -->
+    # per-channel (low, high) values at the percentiles, as np.percentile would give them
+    tiles = [tiles] if isinstance(tiles, np.ndarray) else list(tiles)
+    integer = np.issubdtype(tiles[0].dtype, np.integer)
+    nbr_channels = tiles[0].shape[0]
+
+    if integer:
+        bins = UINT16_BINS
+        lo, width = np.zeros(nbr_channels), np.ones(nbr_channels)
+    else:
+        lo = np.min([tile.min(axis=(1, 2)) for tile in tiles], axis=0).astype(np.float64)
+        hi = np.max([tile.max(axis=(1, 2)) for tile in tiles], axis=0).astype(np.float64)
+        width = np.maximum(hi - lo, np.finfo(np.float32).tiny) / bins
+
+    counts = _histograms(tiles, lo, width, bins)
+
+    # Linear interpolation between the two closest ranks, like np.percentile
+    n = counts[0].sum()
+    positions = (n - 1) * np.asarray(percentiles, dtype=np.float64) / 100
+    below = np.floor(positions)
+    ranks = np.concatenate([below, np.minimum(below + 1, n - 1)])
+    values = _ranked_bins(counts, ranks).astype(np.float64)
+    if not integer:
+        # Bin centers, clamped to the channel's range
+        values = np.minimum(lo[:, np.newaxis] + (values + 0.5) * width[:, np.newaxis], (lo + width * bins)[:, np.newaxis])
+
+    k = len(percentiles)
+    values = values[:, :k] + (positions - below) * (values[:, k:] - values[:, :k])
+    return values[:, 0], values[:, -1]
+
+
+def apply_stretch(data: np.ndarray, low: np.ndarray, high: np.ndarray, out_max: float = 1) -> np.ndarray:
+    # (data - low) / (high - low) * out_max, clipped to [0, out_max]. In place for float
+    # data, integer data gets a float32 result
+    if not np.issubdtype(data.dtype, np.floating):
+        data = data.astype(np.float32)
+    low = np.asarray(low, dtype=data.dtype).reshape(-1, 1, 1)
+    gain = (out_max / np.maximum(np.asarray(high, dtype=np.float64) - np.asarray(low, dtype=np.float64).ravel(),
+                                 np.finfo(np.float32).tiny)).astype(data.dtype).reshape(-1, 1, 1)
+    data -= low
+    data *= gain
+    return np.clip(data, 0, out_max, out=data)
@@ -1,6 +1,10 @@
-import json 
+import json
 import os
-import math
+import numpy as np
+
+from main import init, predict_clouds, CLOUD_FRAC_THRES
+from get_data import get_data, get_product
+from grid import partition_coords
 
 # Sweden is 450,295 km^2
 # Masking sweden by 1km x 1km at a time, with xmin for each call,
@@ -14,60 +18,127 @@ import math
 # 12 workers: 5 hours, 9 minutes, 20 seconds
 # 20 workers: 3 hours, 5 minutes, 12 seconds
 
-def latitude_to_meters(latitude):
-    40075/360*math.cos(latitude) # In km
-
-def partition_coords():
-    return
-
-def run_large_cloudmask(date, data_source, params):
-    # Get bands, models, etc. based on the data sources
-	bands, models, means, stds, cloud_thres, thin_cloud_thres, _ = init(data_source)
-
-	# Get data
-	data = get_data(source=data_source, date=date, params=params)
-	if data == None:
-		return
-
-	img = get_product(data, bands, scaling="downsizing")
-
-	rgb_band_list = ["B09", "B04", "B03", "B02"]
-	RGB = normalize(get_product(data, rgb_band_list, scaling="downsizing"))[1:]
-
-	del data
-
-	img = np.transpose(img, (1, 2, 0))
-	RGB = np.transpose(RGB, (1, 2, 0))
-
-	# Extract image shape
-	H, W = img.shape[:2]
-
-	THRESHOLD_THICKNESS_IS_CLOUD = [cloud_thres] # 0.010  # if COT predicted above this, then predicted as 'opaque cloud' ("thick" cloud)
-	THRESHOLD_THICKNESS_IS_THIN_CLOUD = [thin_cloud_thres] #0.010  # if COT predicted above this, then predicted as 'thin cloud' <-- set to the same as the opaque cloud threshold by default, i.e. it becomes a binary task (cloudy / clear) instead
-	pred_map, pred_map_binary_list, pred_map_binary_thin_list = mlp_inference(img, means, stds, models, H*W,
-																				THRESHOLD_THICKNESS_IS_CLOUD,
-																				THRESHOLD_THICKNESS_IS_THIN_CLOUD,
-																				MLP_POST_FILTER_SZ, 
-																				DEVICE)
- 
-    # def get_cloud mask():
-    # SPLIT PRED MAP INTO PEICES AND ASSERT CLOUD MASK FOR EACH PART
-    #     return None
-
-    # Track stats
-    pred_map_binary = pred_map_binary_list[0]
-    pred_map_binary_thin = pred_map_binary_thin_list[0]
-    frac_binary = 100*np.count_nonzero(pred_map_binary + pred_map_binary_thin) / H / W
-    pred_cloudy = frac_binary > 5.0
-
-    print("Cloudy:", bool(pred_cloudy))
-    if pred_cloudy == False:
-		# DO SOMETHING, STORE THE BOOLs AS ARRAY OR SIMILAR
+# Sources that get_data fetches per tile. L1C only exists as one local scene (get_data.get_l1c_data),
+# which would be returned for every tile
+TILED_SOURCES = ["l2a"]
+
+MASK_RESOLUTION = 60  # Pixel size (m) of the cloud mask mosaic, that of the model input (bands downsized to the 60 m grid)
+MASK_NO_DATA = 255  # Mosaic value outside the AOI and in tiles without data, 0: clear, 1: cloud
+
+def check_tiled_source(data_source: str):
+    if data_source not in TILED_SOURCES:
+        raise ValueError(f"Tiled cloud masks need one of {TILED_SOURCES} as data source, got {data_source}")
+
+def tile_pixels(tile_km: float) -> int:
+    # Side of a (full) tile in the mask mosaic
+    return max(1, round(tile_km * 1000 / MASK_RESOLUTION))
+
+def tile_slot(row: int, col: int, tile_coords: dict, transform: tuple, tile_px: int) -> tuple:
+    # Rows and columns of a tile in the mask mosaic. The tiles along the east/south
+    # edges are cut by the AOI, and get the matching part of their slot
+    _west, dlon, _north, dlat = transform
+    h = max(1, round(tile_px * (tile_coords["north"] - tile_coords["south"]) / dlat))
+    w = max(1, round(tile_px * (tile_coords["east"] - tile_coords["west"]) / dlon))
+    return slice(row * tile_px, row * tile_px + h), slice(col * tile_px, col * tile_px + w)
+
+def paste_tile_mask(mosaic: np.ndarray, tile_mask: np.ndarray, slot: tuple):
+    # Nearest-neighbour resample a tile's cloud mask onto its slot of the mosaic
+    rows, cols = slot
+    h, w = rows.stop - rows.start, cols.stop - cols.start
+    H, W = tile_mask.shape
+    mosaic[rows, cols] = tile_mask[(np.arange(h) * H // h)[:, np.newaxis], np.arange(w) * W // w]
+
+def tile_params(date: str, data_source: str, tile_coords: dict, bands: list) -> dict:
+    # Setup json config for the openeo api
+    return {
+        "geojson": {
+            "time": {
+                "date": date,
+            },
+            "geometry": {
+                "type": "Box",
+                "coords": tile_coords
+            },
+            "collection": data_source,
+            "bands": bands
+            }
+    }
+
+def run_tile(date: str, data_source: str, tile_coords: dict):
+    # Cloud percentage and cloud mask of a single tile, None if there is no data for it.
+    # The mask is None if progressive sampling settled the tile as cloudy without one
+    check_tiled_source(data_source)
+    bands = init(data_source)[0]
+    data = get_data(source=data_source, date=date, params=tile_params(date, data_source, tile_coords, bands))
+    if data == None:
+        return None
+
+    img = np.transpose(get_product(data, bands, scaling="downsizing"), (1, 2, 0))
+    offset, scale = data.offset, data.scale
+    del data
+
+    _pred_cloudy, frac_binary, _pred_map, cloud_mask = predict_clouds(img, data_source, offset, scale)
+    return frac_binary, cloud_mask
+
+def run_large_cloudmask(date: str, data_source: str, coords: dict, tile_km: float = 8.0) -> dict:
+    check_tiled_source(data_source)
+    tiles, shape, transform = partition_coords(coords, tile_km)
+    tile_px = tile_pixels(tile_km)
+
+    # Cloud percentage per tile, NaN where no data could be fetched, and the tiles' cloud masks
+    cloud_frac = np.full(shape, np.nan, dtype=np.float32)
+    cloud_mask = np.full((shape[0] * tile_px, shape[1] * tile_px), MASK_NO_DATA, dtype=np.uint8)
+    for i, (row, col, tile_coords) in enumerate(tiles):
+        result = run_tile(date, data_source, tile_coords)
+        if result is not None:
+            cloud_frac[row, col], tile_mask = result
+            if tile_mask is not None:
+                paste_tile_mask(cloud_mask, tile_mask, tile_slot(row, col, tile_coords, transform, tile_px))
+        print(f"tile {i + 1}/{len(tiles)} ({row}, {col}):", None if result is None else result[0])
+
+    return make_cloud_grid(cloud_frac, cloud_mask, date, data_source, coords, tile_km, transform)
+
+def make_cloud_grid(cloud_frac: np.ndarray, cloud_mask: np.ndarray, date: str, data_source: str, coords: dict,
+                    tile_km: float, transform: tuple) -> dict:
+    # cloud_mask: the uint8 mask mosaic (0: clear, 1: cloud, MASK_NO_DATA)
+    west, dlon, north, dlat = transform
+    tile_px = tile_pixels(tile_km)
+    return {
+        "cloudy": cloud_frac > CLOUD_FRAC_THRES,
+        "valid": ~np.isnan(cloud_frac),
+        "cloud_mask": cloud_mask == 1,
+        "mask_valid": cloud_mask != MASK_NO_DATA,
+        "date": date,
+        "data_source": data_source,
+        "coords": coords,
+        "tile_km": tile_km,
+        "transform": transform,
+        "mask_transform": (west, dlon / tile_px, north, dlat / tile_px),
+    }
+
+GRID_ARRAYS = ["cloudy", "valid", "cloud_mask", "mask_valid"]
+
+def save_cloud_grid(save_path: str, grid: dict) -> str:
+    # Bit-packed boolean grids and masks plus the metadata needed to georeference them
+    meta = {key: value for key, value in grid.items() if key not in GRID_ARRAYS}
+    meta["shapes"] = {key: grid[key].shape for key in GRID_ARRAYS}
+    np.savez_compressed(save_path, meta=json.dumps(meta),
+                        **{key: np.packbits(grid[key], axis=None) for key in GRID_ARRAYS})
+    return save_path
+
+def load_cloud_grid(load_path: str) -> dict:
+    with np.load(load_path) as f:
+        grid = json.loads(str(f["meta"]))
+        # Grids saved before the masks: only the per-tile arrays
+        shapes = grid.pop("shapes") if "shapes" in grid else dict.fromkeys(["cloudy", "valid"], grid.pop("shape"))
+        for key, shape in shapes.items():
+            grid[key] = np.unpackbits(f[key], count=int(np.prod(shape))).astype(bool).reshape(shape)
+    return grid
 
 if __name__ == "__main__":
 
     json_coords = os.getenv("coords", default=None)
-    if not json_coords:
+    if json_coords:
         coords = json.loads(json_coords)
     else:
         from max_coords import *
@@ -79,19 +150,13 @@ if __name__ == "__main__":
 
     date = os.getenv("date", default="2022-01-01")
     data_source = os.getenv("data_source", default="l2a")
-    print(date, data_source, coords)
-
-    params = {
-		"geojson": { 
-			"time": {
-				"date": date,
-			},
-			"geometry": { 
-				"type": "Box",
-    			"coords": coords
-			},
-			"collection": data_source,
-			"bands": ["B01", "B02", "B03", "B04", "B05", "B06", "B07", "B08", "B8A", "B09", "B10", "B11", "B12", "scl"]
-			}
-	}
-    run_cloud_prediction(date=date, data_source=data_source, params=params)
\ No newline at end of file
+    tile_km = float(os.getenv("tile_km", default="8"))
+    nbr_workers = int(os.getenv("workers", default="1"))  # > 1 --> local multi-core execution, see tile_executor.py
+    print(date, data_source, coords, tile_km)
+
+    if nbr_workers > 1:
+        from tile_executor import run_local_cloudmask
+        grid = run_local_cloudmask(date, data_source, coords, tile_km, nbr_workers)
+    else:
+        grid = run_large_cloudmask(date, data_source, coords, tile_km)
+    print("saving: ", save_cloud_grid(f"../outputs/cloudgrid_{date}_{data_source}.npz", grid))
@@ -0,0 +1,67 @@
+import os
+import numpy as np
+import pytest
+
+from bundle import load_bundle
+from inference import load_ensemble, mlp_inference
+
+# Checks of the inference paths against each other on the packed ensembles, run with
+# python -m pytest from this directory
+
+MODELS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "models")
+SOURCES = ["l1c", "l2a"]
+
+
+def _bundle(source):
+    return load_bundle(os.path.join(MODELS_DIR, f"{source}_ensemble.bundle"))
+
+
+def _inputs(bundle, H=200, W=200, spread=0.7, seed=0):
+    # Reflectance-like input around the training distribution: mean + spread * std * N(0, 1)
+    rng = np.random.default_rng(seed)
+    return (bundle.means + spread * bundle.stds * rng.standard_normal((H, W, len(bundle.means)))).astype(np.float32)
+
+
+def _run(bundle, img, backend, **kwargs):
+    ensemble = load_ensemble(bundle, backend)
+    H, W = img.shape[:2]
+    return mlp_inference(img, bundle.means, bundle.stds, ensemble, H * W, [bundle.cloud_thres], [bundle.thin_cloud_thres],
+                         1, backend=backend, **kwargs)
+
+
+@pytest.mark.parametrize("source", SOURCES)
+@pytest.mark.parametrize("mem_budget_mb", [None, 1])
+def test_numpy_backend_matches_torch(source, mem_budget_mb):
+    pytest.importorskip("torch")
+    bundle = _bundle(source)
+    img = _inputs(bundle)
+
+    torch_map, torch_binary, torch_thin = _run(bundle, img, "torch", mem_budget_mb=mem_budget_mb)
+    numpy_map, numpy_binary, numpy_thin = _run(bundle, img, "numpy", mem_budget_mb=mem_budget_mb)
+
+    np.testing.assert_allclose(numpy_map, torch_map, rtol=0, atol=1e-6)
+    assert np.array_equal(numpy_binary[0], torch_binary[0])
+    assert np.array_equal(numpy_thin[0], torch_thin[0])
+
+
+# Largest share of pixels whose (thick or thin) cloud mask may differ between the adaptive
+# and the full ensemble, and largest change of the cloud percentage, in percent
+ADAPTIVE_MAX_DISAGREEMENT = 0.05
+ADAPTIVE_MAX_FRAC_CHANGE = 0.05
+
+
+@pytest.mark.parametrize("source", SOURCES)
+@pytest.mark.parametrize("spread, seed", [(0.4, 1), (0.7, 2), (1.0, 3)])
+def test_adaptive_ensemble_agrees_with_full(source, spread, seed):
+    bundle = _bundle(source)
+    img = _inputs(bundle, spread=spread, seed=seed)
+
+    _, full_binary, full_thin = _run(bundle, img, "numpy")
+    stats = {}
+    _, adaptive_binary, adaptive_thin = _run(bundle, img, "numpy", adaptive=True, stats=stats)
+
+    full_mask = full_binary[0] | full_thin[0]
+    adaptive_mask = adaptive_binary[0] | adaptive_thin[0]
+    assert 100 * np.mean(full_mask != adaptive_mask) <= ADAPTIVE_MAX_DISAGREEMENT
+    assert abs(100 * (adaptive_mask.mean() - full_mask.mean())) <= ADAPTIVE_MAX_FRAC_CHANGE
+    assert stats["skipped_evaluations"] > 0
@@ -0,0 +1,101 @@
+import multiprocessing as mp
+import os
+import numpy as np
+
+from multiprocessing import shared_memory
+
+# Local multi-core execution of the tiled cloud mask: the tiles of a large AOI are
+# fanned out over a pool of worker processes that keep their models warm and write
+# their pixel-level cloud masks straight into a shared-memory mosaic of the whole AOI.
+# Only the per-tile cloud percentages travel back through the pool.
+
+# Thread pools that are sized from these at import time (BLAS, OpenMP, torch)
+THREAD_ENV_VARS = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "NUMEXPR_NUM_THREADS"]
+
+# Per worker process state, set up by _init_worker
+_worker = {}
+
+
+def _init_worker(shm_name: str, mosaic_shape: tuple, transform: tuple, tile_px: int, date: str, data_source: str,
+                 threads_per_worker: int):
+    from main import init, INFERENCE_BACKEND
+
+    if INFERENCE_BACKEND == "torch":
+        import torch
+        torch.set_num_threads(threads_per_worker)
+        torch.set_num_interop_threads(1)
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _worker["shm"] = shm
+    _worker["cloud_mask"] = np.ndarray(mosaic_shape, dtype=np.uint8, buffer=shm.buf)
+    _worker["transform"] = transform
+    _worker["tile_px"] = tile_px
+    _worker["date"] = date
+    _worker["data_source"] = data_source
+
+    # Warm up the (process-level cached) models once per worker
+    init(data_source)
+
+
+def _run_tile(tile: tuple) -> tuple:
+    from swedish_cloud_bool_mask import run_tile, paste_tile_mask, tile_slot
+
+    row, col, tile_coords = tile
+    result = run_tile(_worker["date"], _worker["data_source"], tile_coords)
+    if result is None:
+        return row, col, None
+
+    frac, tile_mask = result
+    if tile_mask is not None:
+        paste_tile_mask(_worker["cloud_mask"], tile_mask, tile_slot(row, col, tile_coords, _worker["transform"], _worker["tile_px"]))
+    return row, col, float(frac)
+
+
+def run_local_cloudmask(date: str, data_source: str, coords: dict, tile_km: float = 8.0,
+                        nbr_workers: int = None, threads_per_worker: int = 1) -> dict:
+    from swedish_cloud_bool_mask import partition_coords, make_cloud_grid, check_tiled_source, tile_pixels, MASK_NO_DATA
+
+    check_tiled_source(data_source)
+    tiles, shape, transform = partition_coords(coords, tile_km)
+    tile_px = tile_pixels(tile_km)
+    mosaic_shape = (shape[0] * tile_px, shape[1] * tile_px)
+    if nbr_workers is None:
+        nbr_workers = max(1, (os.cpu_count() or 1) // threads_per_worker)
+
+    # Cloud percentage per tile, NaN where no data could be fetched
+    cloud_frac = np.full(shape, np.nan, dtype=np.float32)
+
+    # Output mosaic: the tiles' cloud masks, each at its pixel offset
+    shm = shared_memory.SharedMemory(create=True, size=int(np.prod(mosaic_shape)))
+    try:
+        cloud_mask = np.ndarray(mosaic_shape, dtype=np.uint8, buffer=shm.buf)
+        cloud_mask[:] = MASK_NO_DATA
+
+        # Workers are spawned with their thread pools capped, so that
+        # nbr_workers * threads_per_worker does not oversubscribe the cores
+        saved_env = {var: os.environ.get(var) for var in THREAD_ENV_VARS}
+        os.environ.update({var: str(threads_per_worker) for var in THREAD_ENV_VARS})
+        try:
+            pool = mp.get_context("spawn").Pool(nbr_workers, initializer=_init_worker,
+                                                initargs=(shm.name, mosaic_shape, transform, tile_px, date, data_source,
+                                                          threads_per_worker))
+        finally:
+            for var, value in saved_env.items():
+                if value is None:
+                    os.environ.pop(var, None)
+                else:
+                    os.environ[var] = value
+
+        with pool:
+            for i, (row, col, frac) in enumerate(pool.imap_unordered(_run_tile, tiles)):
+                if frac is not None:
+                    cloud_frac[row, col] = frac
+                print(f"tile {i + 1}/{len(tiles)} ({row}, {col}):", frac)
+
+        grid = make_cloud_grid(cloud_frac, cloud_mask, date, data_source, coords, tile_km, transform)
+        del cloud_mask
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return grid
@@ -0,0 +1,158 @@
+import json
+import os
+import tempfile
+import zlib
+import numpy as np
+
+# Chunked, compressed time-series store for per-date rasters of a tile (COT maps,
+# cloud masks, ...) on the local filesystem, along the lines of Zarr:
+#
+#   root/{tile}/meta.json                   grid and chunking, written once
+#   root/{tile}/{array}/{date}/{row}.{col}  one zlib-compressed chunk
+#   root/{tile}/dates/{date}.json           the date's arrays and attributes
+#
+# Every date is one step of an appendable time axis and is chunked spatially only,
+# so appending never rewrites earlier data, and reading a spatial window or a time
+# slice only decompresses the chunks it covers. Boolean arrays are bit-packed,
+# floats are stored as float16.
+#
+# Writers never read-modify-write a shared file: the dates are whatever records are
+# on disk, and a date's record is renamed into place after its chunks. So concurrent
+# jobs can append different dates to the same tile.
+
+CHUNK_SIZE = (256, 256)
+COMPRESS_LEVEL = 4
+
+STORED_DTYPES = {"b": np.bool_, "f": np.float16}
+
+
+def _stored_dtype(dtype) -> np.dtype:
+    return np.dtype(STORED_DTYPES.get(np.dtype(dtype).kind, dtype))
+
+
+def _encode(chunk: np.ndarray, level: int) -> bytes:
+    if chunk.dtype == np.bool_:
+        chunk = np.packbits(chunk, axis=None)
+    return zlib.compress(np.ascontiguousarray(chunk).tobytes(), level)
+
+
+def _decode(payload: bytes, dtype: np.dtype, shape: tuple) -> np.ndarray:
+    raw = zlib.decompress(payload)
+    if dtype == np.bool_:
+        return np.unpackbits(np.frombuffer(raw, dtype=np.uint8), count=int(np.prod(shape))).astype(bool).reshape(shape)
+    return np.frombuffer(raw, dtype=dtype).reshape(shape)
+
+
+def _write_atomic(path: str, payload: bytes, replace: bool = True) -> bool:
+    # Written to a temporary file and moved into place, so readers never see half of it.
+    # replace=False only creates the file if there is none yet. Returns whether it was written
+    fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", dir=os.path.dirname(path))
+    with os.fdopen(fd, "wb") as f:
+        f.write(payload)
+    if replace:
+        os.replace(tmp_path, path)
+        return True
+    try:
+        os.link(tmp_path, path)
+        return True
+    except FileExistsError:
+        return False
+    finally:
+        os.remove(tmp_path)
+
+
+class TimeSeriesStore():
+    """
+    Per-tile, appendable time series of 2D arrays, chunked and compressed on disk
+    """
+    def __init__(self, root: str, chunk_size: tuple = CHUNK_SIZE, level: int = COMPRESS_LEVEL):
+        self.root = root
+        self.chunk_size = tuple(chunk_size)
+        self.level = level
+
+    def tiles(self) -> list:
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(tile for tile in os.listdir(self.root) if os.path.exists(os.path.join(self.root, tile, "meta.json")))
+
+    def meta(self, tile: str) -> dict:
+        try:
+            with open(os.path.join(self.root, tile, "meta.json")) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def dates(self, tile: str) -> list:
+        dates_dir = os.path.join(self.root, tile, "dates")
+        if not os.path.isdir(dates_dir):
+            return []
+        return sorted(name[: -len(".json")] for name in os.listdir(dates_dir) if name.endswith(".json"))
+
+    def record(self, tile: str, date: str) -> dict:
+        # {"arrays": {name: dtype}, "attrs": {...}} of one date
+        try:
+            with open(os.path.join(self.root, tile, "dates", date + ".json")) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise KeyError(f"{date} not in tile {tile}")
+
+    def attrs(self, tile: str, date: str) -> dict:
+        # Attributes stored with one date, e.g. the model and thresholds it was made with
+        return self.record(tile, date)["attrs"]
+
+    def append(self, tile: str, date: str, arrays: dict, attrs: dict = None, transform: tuple = None, crs: str = None):
+        # Add one date of arrays ({name: (H, W) array}) to a tile. A date that is already
+        # stored is overwritten
+        shape = next(iter(arrays.values())).shape
+        tile_dir = os.path.join(self.root, tile)
+        os.makedirs(os.path.join(tile_dir, "dates"), exist_ok=True)
+
+        # The first writer of a tile sets its grid, everyone else uses it
+        meta = {"shape": list(shape), "chunk_size": list(self.chunk_size), "transform": transform, "crs": crs}
+        _write_atomic(os.path.join(tile_dir, "meta.json"), json.dumps(meta).encode(), replace=False)
+        meta = self.meta(tile)
+        if tuple(meta["shape"]) != tuple(shape):
+            raise ValueError(f"Tile {tile} is {tuple(meta['shape'])}, got arrays of {tuple(shape)}")
+
+        ch, cw = meta["chunk_size"]
+        dtypes = {}
+        for name, array in arrays.items():
+            dtype = _stored_dtype(array.dtype)
+            dtypes[name] = dtype.str
+            date_dir = os.path.join(tile_dir, name, date)
+            os.makedirs(date_dir, exist_ok=True)
+            for r in range(0, shape[0], ch):
+                for c in range(0, shape[1], cw):
+                    chunk = np.asarray(array[r : r + ch, c : c + cw], dtype=dtype)
+                    _write_atomic(os.path.join(date_dir, f"{r // ch}.{c // cw}"), _encode(chunk, self.level))
+
+        # The chunks are in place before the date becomes visible
+        record = {"arrays": dtypes, "attrs": attrs or {}}
+        _write_atomic(os.path.join(tile_dir, "dates", date + ".json"), json.dumps(record).encode())
+
+    def read(self, tile: str, name: str, dates: list = None, window: tuple = None) -> tuple:
+        # --> ((T, h, w) array, dates) for the given dates (default: all) and spatial window
+        # ((row start, row stop), (col start, col stop), default: the whole tile).
+        # Only the chunks that overlap the window are read
+        meta = self.meta(tile)
+        dates = self.dates(tile) if dates is None else list(dates)
+        dtypes = [np.dtype(self.record(tile, date)["arrays"][name]) for date in dates]
+
+        H, W = meta["shape"]
+        ch, cw = meta["chunk_size"]
+        (r0, r1), (c0, c1) = window if window is not None else ((0, H), (0, W))
+        r1, c1 = min(r1, H), min(c1, W)
+
+        out = np.empty((len(dates), r1 - r0, c1 - c0), dtype=dtypes[0] if dtypes else np.float16)
+        for t, (date, dtype) in enumerate(zip(dates, dtypes)):
+            date_dir = os.path.join(self.root, tile, name, date)
+            for cr in range(r0 // ch, (r1 - 1) // ch + 1):
+                for cc in range(c0 // cw, (c1 - 1) // cw + 1):
+                    shape = (min(ch, H - cr * ch), min(cw, W - cc * cw))
+                    with open(os.path.join(date_dir, f"{cr}.{cc}"), "rb") as f:
+                        chunk = _decode(f.read(), dtype, shape)
+                    # Overlap of the chunk and the window, in tile coordinates
+                    tr0, tr1 = max(r0, cr * ch), min(r1, cr * ch + shape[0])
+                    tc0, tc1 = max(c0, cc * cw), min(c1, cc * cw + shape[1])
+                    out[t, tr0 - r0 : tr1 - r0, tc0 - c0 : tc1 - c0] = chunk[tr0 - cr * ch : tr1 - cr * ch, tc0 - cc * cw : tc1 - cc * cw]
+        return out, dates
@@ -8,7 +8,9 @@ from scipy.special import expit
 import gc
 import matplotlib.pyplot as plt
 import torch
-import torch.nn as nn
+
+from inference import mlp_inference, _mlp_post_filter
+from model import MLP5, MLP5Ensemble
 
 
 def replace(string_in, replace_from, replace_to='_'):
@@ -309,131 +311,6 @@ def get_random_crop(H, W, crop_size, coords=None, min_frame=0, H_MIN=0, W_MIN=0)
                 return [start_h, end_h, start_w, end_w], coords_inside, np.array(idxs_inside)
     return None, None, None
 
-# def _mlp_post_filter(pred_map_binary_list, pred_map_binary_thin_list, pred_map, thresh_thin_cloud, post_filt_sz):
-# 	if post_filt_sz == 1:
-# 		return pred_map_binary_list, pred_map_binary_thin_list
-# 	H, W = pred_map.shape
-# 	for list_idx, pred_map_binary in enumerate(pred_map_binary_list):
-# 		tmp_map = np.zeros_like(pred_map)
-# 		tmp_map_thin = np.zeros_like(pred_map)
-# 		count_map = np.zeros_like(pred_map)
-# 		for i_start in range(post_filt_sz):
-# 			for j_start in range(post_filt_sz):
-# 				for i in range(i_start, H // post_filt_sz):
-# 					for j in range(j_start, W // post_filt_sz):
-# 						count_map[i * post_filt_sz : (i + 1) * post_filt_sz, j * post_filt_sz : (j + 1) * post_filt_sz] += 1
-# 						curr_patch = pred_map_binary[i * post_filt_sz : (i + 1) * post_filt_sz, j * post_filt_sz : (j + 1) * post_filt_sz]
-# 						curr_patch_thin = pred_map_binary_thin_list[min(list_idx, len(thresh_thin_cloud) - 1)][i * post_filt_sz : (i + 1) * post_filt_sz, j * post_filt_sz : (j + 1) * post_filt_sz]
-# 						if np.count_nonzero(curr_patch) >= np.prod(curr_patch.shape) // 2:
-# 							tmp_map[i * post_filt_sz : (i + 1) * post_filt_sz, j * post_filt_sz : (j + 1) * post_filt_sz] += 1
-# 						if np.count_nonzero(curr_patch_thin) >= np.prod(curr_patch_thin.shape) // 2:
-# 							tmp_map_thin[i * post_filt_sz : (i + 1) * post_filt_sz, j * post_filt_sz : (j + 1) * post_filt_sz] += 1
-# 		tmp_map[count_map == 0] = 0
-# 		count_map[count_map == 0] = 1
-# 		tmp_map /= count_map
-# 		assert np.min(tmp_map) >= 0 and np.max(tmp_map) <= 1
-# 		pred_map_binary = tmp_map >= 0.50
-# 		pred_map_binary_list[list_idx] = pred_map_binary
-
-# 		tmp_map_thin[count_map == 0] = 0
-# 		tmp_map_thin /= count_map
-# 		assert np.min(tmp_map_thin) >= 0 and np.max(tmp_map_thin) <= 1
-# 		pred_map_binary_thin = tmp_map_thin >= 0.50
-# 		pred_map_binary_thin_list[min(list_idx, len(thresh_thin_cloud) - 1)] = pred_map_binary_thin
-
-# 		# 'Aliasing effect' after this filtering can cause BOTH thin and regular cloud to be active at the same time -- give prevalence to regular
-# 		pred_map_binary_thin_list[0][pred_map_binary_list[0]] = 0
-
-# 	return pred_map_binary_list, pred_map_binary_thin_list
-
-def _mlp_post_filter(pred_map_binary_list, pred_map_binary_thin_list, pred_map, thresh_thin_cloud, post_filt_sz):
-    if post_filt_sz == 1:
-        return pred_map_binary_list, pred_map_binary_thin_list
-
-    H, W = pred_map.shape
-
-    for list_idx, pred_map_binary in enumerate(pred_map_binary_list):
-        tmp_map = np.zeros_like(pred_map, dtype=float)
-        tmp_map_thin = np.zeros_like(pred_map, dtype=float)
-        count_map = np.zeros_like(pred_map, dtype=int)
-
-        binary_thin = pred_map_binary_thin_list[min(list_idx, len(thresh_thin_cloud) - 1)]
-
-        # Sliding window processing
-        for i in range(0, H, post_filt_sz):
-            for j in range(0, W, post_filt_sz):
-                patch_slice = (slice(i, min(i + post_filt_sz, H)),
-                               slice(j, min(j + post_filt_sz, W)))
-
-                # Extract patches
-                curr_patch = pred_map_binary[patch_slice]
-                curr_patch_thin = binary_thin[patch_slice]
-
-                # Update maps and counts
-                if np.count_nonzero(curr_patch) >= curr_patch.size // 2:
-                    tmp_map[patch_slice] += 1
-                if np.count_nonzero(curr_patch_thin) >= curr_patch_thin.size // 2:
-                    tmp_map_thin[patch_slice] += 1
-                count_map[patch_slice] += 1
-
-        # Normalize and threshold
-        tmp_map = np.divide(tmp_map, count_map, out=np.zeros_like(tmp_map), where=count_map > 0)
-        tmp_map_thin = np.divide(tmp_map_thin, count_map, out=np.zeros_like(tmp_map_thin), where=count_map > 0)
-
-        # Threshold maps
-        pred_map_binary_list[list_idx] = tmp_map >= 0.50
-        pred_map_binary_thin_list[min(list_idx, len(thresh_thin_cloud) - 1)] = tmp_map_thin >= 0.50
-
-        # Resolve conflicts between thin and regular cloud maps
-        pred_map_binary_thin_list[0][pred_map_binary_list[0]] = 0
-
-    return pred_map_binary_list, pred_map_binary_thin_list
-
-
-# Setup MLP-computation function
-def mlp_inference(img, means, stds, models, batch_size, thresh_cloud, thresh_thin_cloud, post_filt_sz, device='cpu', predict_also_cloud_binary=False):
-	H, W, input_dim = img.shape
-	img_torch = torch.reshape((torch.Tensor(img).to(device) - means) / stds, [H * W, input_dim])
-	pred_map_tot = 0.0
-	pred_map_binary_tot = 0.0
-	for model in models:
-		pred_map = np.zeros(H * W)
-		pred_map_binary = np.zeros(H * W)
-		for i in range(0, H * W, batch_size):
-			curr_pred = model(img_torch[i : i + batch_size, :])
-			pred_map[i : i + batch_size] = curr_pred[:, 0].cpu().detach().numpy()
-			if predict_also_cloud_binary:
-				pred_map_binary[i : i + batch_size] = curr_pred[:, 1].cpu().detach().numpy()
-		pred_map = np.reshape(pred_map, [H, W])
-		if predict_also_cloud_binary:
-			pred_map_binary = np.reshape(expit(pred_map_binary), [H, W]) >= 0.5
-		else:
-			pred_map_binary = np.zeros_like(pred_map)#pred_map >= thresh_cloud[-1] <<--- overwritten anyway
-			
-		# Average model predictions
-		pred_map_tot += pred_map / len(models)
-		pred_map_binary_tot += pred_map_binary.astype(float) / len(models)
-		
-	# Return final predictions
-	pred_map = pred_map_tot
-	if predict_also_cloud_binary:
-		pred_map_binary = pred_map_binary_tot >= 0.5
-	else:
-		pred_map_binary_list = []
-		pred_map_binary_thin_list = []
-		for thresh in thresh_cloud:
-			pred_map_binary_list.append(pred_map_tot >= thresh)
-		for thresh in thresh_thin_cloud:
-			# Below: A thin cloud is a thin cloud only if it is above the thin thresh AND below the regular cloud thresh
-			pred_map_binary_thin_list.append(np.logical_and(pred_map_tot >= thresh, pred_map_tot < thresh_cloud[0]))
-
-	# Potentially do post-processing on the cloud/not cloud (binary)
-	# prediction, so that it becomes more spatially coherent
-	pred_map_binary_list, pred_map_binary_thin_list = _mlp_post_filter(pred_map_binary_list, pred_map_binary_thin_list, pred_map, thresh_thin_cloud, post_filt_sz)
-
-	# Return
-	return pred_map, pred_map_binary_list, pred_map_binary_thin_list
-
 # Compute mIoU
 # See https://datascience.stackexchange.com/questions/104746/is-there-an-official-procedure-to-compute-miou
 # which says there is no 'official' way to compute mIoU. Either one can do it by computing the mIoU per image
@@ -511,29 +388,3 @@ def eval_swe_forest_cls(base_path, split='train'):
 	print("F1 score (balanced): %.4f" % (0.5 * (f1_0 + f1_1)))
 	print("F1 score (gt is clear (0)): %.4f" % (f1_0))
 	print("F1 score (gt is cloudy (1)): %.4f" % (f1_1))
-
-# Simple 5-layer MLP model
-class MLP5(nn.Module):
-	def __init__(self, input_dim, output_dim=1, hidden_dim=64, apply_relu=True):
-		super(MLP5, self).__init__()
-		self.lin1 = nn.Linear(input_dim, hidden_dim)
-		self.lin2 = nn.Linear(hidden_dim, hidden_dim)
-		self.lin3 = nn.Linear(hidden_dim, hidden_dim)
-		self.lin4 = nn.Linear(hidden_dim, hidden_dim)
-		self.lin5 = nn.Linear(hidden_dim, output_dim)
-		self.relu = nn.ReLU()
-		self.apply_relu = apply_relu
-
-	def forward(self, x):
-		x1 = self.lin1(x)
-		x1 = self.relu(x1)
-		x2 = self.lin2(x1)
-		x2 = self.relu(x2)
-		x3 = self.lin3(x2)
-		x3 = self.relu(x3)
-		x4 = self.lin4(x3)
-		x4 = self.relu(x4)
-		x5 = self.lin5(x4)
-		if self.apply_relu:
-			x5[:, 0] = self.relu(x5[:, 0])  # NB: cloud optical thicknesses cannot be negative
-		return x5
\ No newline at end of file
@@ -0,0 +1,75 @@
+import numpy as np
+
+from affine import Affine
+from PIL import Image
+from rasterio.io import MemoryFile
+from rasterio.shutil import copy as copy_raster
+
+# Headless output of products and masks: 8-bit PNGs for viewing and tiled, compressed,
+# georeferenced Cloud-Optimized GeoTIFFs. Arrays are written as they are, no figures involved.
+
+COG_BLOCK_SIZE = 512
+COG_COMPRESS = "deflate"
+
+FORMAT_EXTENSIONS = {"png": ".png", "cog": ".tif"}
+
+
+def to_uint8(image: np.ndarray) -> np.ndarray:
+    # [0, 1] floats and booleans --> [0, 255] bytes, bytes as they are
+    if image.dtype == np.uint8:
+        return image
+    if image.dtype == bool:
+        return image.view(np.uint8) * np.uint8(255)
+    out = np.clip(image, 0, 1)
+    out *= 255
+    out += 0.5
+    return out.astype(np.uint8)
+
+
+def write_png(save_path: str, image: np.ndarray) -> str:
+    # (H, W) or (H, W, 3) image
+    Image.fromarray(to_uint8(image)).save(save_path)
+    return save_path
+
+
+def write_cog(save_path: str, image: np.ndarray, transform: tuple = None, crs: str = None,
+              nodata: float = None, resampling: str = "average") -> str:
+    # (H, W) or (H, W, bands) image --> Cloud-Optimized GeoTIFF, in the image's dtype.
+    # transform: (a, b, c, d, e, f) geotransform, resampling: how the overviews are made
+    bands = image[np.newaxis] if image.ndim == 2 else np.transpose(image, (2, 0, 1))
+    if bands.dtype == bool:
+        bands = bands.view(np.uint8)
+        resampling = "nearest"
+
+    profile = {
+        "driver": "GTiff",
+        "count": bands.shape[0],
+        "height": bands.shape[1],
+        "width": bands.shape[2],
+        "dtype": bands.dtype,
+        "nodata": nodata,
+    }
+    if transform is not None:
+        profile.update(transform=Affine(*transform), crs=crs)
+
+    # Laid out as a COG (tiles, overviews, header first) by GDAL's COG driver
+    with MemoryFile() as memfile:
+        with memfile.open(**profile) as dataset:
+            dataset.write(bands)
+        with memfile.open() as dataset:
+            copy_raster(dataset, save_path, driver="COG", compress=COG_COMPRESS,
+                        blocksize=COG_BLOCK_SIZE, overview_resampling=resampling)
+    return save_path
+
+
+def write_image(save_path: str, image: np.ndarray, formats: list = ["png"], transform: tuple = None,
+                crs: str = None, **cog_kwargs) -> list:
+    # Write image in each of the formats, save_path without extension. Returns the written paths
+    paths = []
+    for fmt in formats:
+        path = save_path + FORMAT_EXTENSIONS[fmt]
+        if fmt == "png":
+            paths.append(write_png(path, image))
+        elif fmt == "cog":
+            paths.append(write_cog(path, image, transform, crs, **cog_kwargs))
+    return paths
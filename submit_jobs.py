@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Fan a (date range x tile grid) cloud filtering run out over ColonyOS executors.
+
+Every job runs my_cloud_filtering/main.py in batch mode on a block of consecutive
+dates for a group of tiles. The function specs are built in memory from a template
+(get_cloud_free.json by default), so concurrent runs never touch each other's files.
+
+    python3 submit_jobs.py 2022-01-01 2022-01-31
+    python3 submit_jobs.py 2022-01-01 2022-03-31 --coords '{"east": ..., ...}' --tile-km 8 --wait
+"""
+import argparse
+import copy
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "my_cloud_filtering"))
+from grid import date_range, partition_coords
+
+# Rough costs of a job, used to size the batches: a job's fixed overhead (container start,
+# imports, model load, openEO login) and the time per scene once it is running
+STARTUP_SECONDS = 90
+SCENE_SECONDS = 15
+MAX_OVERHEAD = 0.2  # Largest share of a job's time that may go to its startup
+
+# Shared band cache (see my_cloud_filtering/band_cache.py), only mounted with --band-cache-gb:
+# the fs mount syncs the whole directory into every container before the job starts
+CACHE_FS_DIR = {
+    "label": "/cache",
+    "dir": "/cache",
+    "keepfiles": False,
+    "onconflicts": {"onstart": {"keeplocal": False}, "onclose": {"keeplocal": True}},
+}
+
+
+def chunks(items: list, size: int) -> list:
+    return [items[i : i + size] for i in range(0, len(items), size)]
+
+
+def scenes_per_job(nbr_scenes: int, nbr_executors: int, max_exec_time: float,
+                   startup_s: float = STARTUP_SECONDS, scene_s: float = SCENE_SECONDS) -> int:
+    # Enough scenes that the startup is at most MAX_OVERHEAD of a job, but no more than
+    # fit within the spec's max execution time or than keep every executor busy
+    amortized = math.ceil(startup_s * (1 - MAX_OVERHEAD) / (MAX_OVERHEAD * scene_s))
+    fits = max(1, int((0.8 * max_exec_time - startup_s) // scene_s))
+    spread = max(1, math.ceil(nbr_scenes / nbr_executors))
+    return max(1, min(amortized, fits, spread))
+
+
+def plan_jobs(dates: list, tiles: list, batch: int) -> list:
+    # tiles: [(name, coords), ...] --> [(dates, tiles), ...]. Blocks of consecutive dates
+    # first, then tiles grouped so that each job holds about batch scenes
+    date_batch = min(batch, len(dates))
+    tile_batch = max(1, batch // date_batch)
+    return [(job_dates, job_tiles) for job_tiles in chunks(tiles, tile_batch) for job_dates in chunks(dates, date_batch)]
+
+
+def make_spec(template: dict, job_dates: list, job_tiles: list, data_source: str, band_cache_gb: float = None,
+              startup_s: float = STARTUP_SECONDS, scene_s: float = SCENE_SECONDS) -> dict:
+    spec = copy.deepcopy(template)
+    env = spec.setdefault("env", {})
+    env.pop("date", None)
+    env.update({
+        "start_date": job_dates[0],
+        "end_date": job_dates[-1],
+        "data_source": data_source,
+        "coords": json.dumps([coords for _, coords in job_tiles]),
+        # Tile names keep the outputs of different jobs apart
+        "aoi_names": json.dumps([name for name, _ in job_tiles]),
+    })
+    if band_cache_gb:
+        env.update({"band_cache_dir": "../cache", "band_cache_max_gb": str(band_cache_gb)})
+        spec.setdefault("fs", {}).setdefault("dirs", []).append(copy.deepcopy(CACHE_FS_DIR))
+
+    # Leave room for the whole batch
+    expected = startup_s + scene_s * len(job_dates) * len(job_tiles)
+    spec["maxexectime"] = max(spec.get("maxexectime", 0), math.ceil(1.5 * expected))
+    if "walltime" in spec.get("conditions", {}):
+        spec["conditions"]["walltime"] = max(spec["conditions"]["walltime"], spec["maxexectime"] + 100)
+    return spec
+
+
+def submit(spec: dict, wait: bool = False, retries: int = 1) -> dict:
+    # Submit one function spec with the colonies CLI, from a private temporary file
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+        json.dump(spec, f, indent=4)
+        spec_path = f.name
+
+    cmd = ["colonies", "function", "submit", "--spec", spec_path] + (["--wait"] if wait else [])
+    try:
+        for attempt in range(retries + 1):
+            start_time = time.time()
+            result = subprocess.run(cmd, capture_output=True, text=True)
+            if result.returncode == 0:
+                break
+    finally:
+        os.remove(spec_path)
+
+    return {
+        "returncode": result.returncode,
+        "attempts": attempt + 1,
+        "seconds": round(time.time() - start_time, 1),
+        "output": (result.stdout + result.stderr).strip()[-2000:],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("start_date")
+    parser.add_argument("end_date")
+    parser.add_argument("--spec", default="get_cloud_free.json", help="function spec template")
+    parser.add_argument("--coords", default=None, help="bounding box (JSON), default: the template's")
+    parser.add_argument("--tile-km", type=float, default=None, help="split the box into tiles of this size")
+    parser.add_argument("--data-source", default=None, help="l1c or l2a, default: the template's")
+    parser.add_argument("--band-cache-gb", type=float, default=None,
+                        help="mount the shared band cache, capped at this size (every job syncs it at start)")
+    parser.add_argument("--executors", type=int, default=4, help="executors available to the run")
+    parser.add_argument("--batch", type=int, default=None, help="scenes per job, default: sized from the startup cost")
+    parser.add_argument("--parallel", type=int, default=8, help="concurrent submissions")
+    parser.add_argument("--wait", action="store_true", help="wait for every job to finish")
+    parser.add_argument("--retries", type=int, default=1, help="resubmissions of a failed job")
+    parser.add_argument("--dry-run", action="store_true", help="print the specs instead of submitting them")
+    parser.add_argument("--report", default=None, help="save the per-job results to this JSON file")
+    args = parser.parse_args()
+
+    with open(args.spec) as f:
+        template = json.load(f)
+
+    coords = json.loads(args.coords or template["env"]["coords"])
+    data_source = args.data_source or template["env"].get("data_source", "l2a")
+    if args.tile_km:
+        tiles = [(f"r{row}c{col}", tile) for row, col, tile in partition_coords(coords, args.tile_km)[0]]
+    else:
+        tiles = [("", coords)]
+    dates = date_range(args.start_date, args.end_date)
+
+    batch = args.batch or scenes_per_job(len(dates) * len(tiles), args.executors, template.get("maxexectime", 1000))
+    jobs = plan_jobs(dates, tiles, batch)
+    specs = [make_spec(template, job_dates, job_tiles, data_source, args.band_cache_gb) for job_dates, job_tiles in jobs]
+    print(f"{len(dates)} dates x {len(tiles)} tiles --> {len(specs)} jobs of up to {batch} scenes")
+
+    if args.dry_run:
+        for spec in specs:
+            print(json.dumps(spec["env"]))
+        return
+
+    # Submit in parallel and report jobs as they complete (are accepted, without --wait)
+    results = [None] * len(specs)
+    with ThreadPoolExecutor(max_workers=args.parallel) as executor:
+        futures = {executor.submit(submit, spec, args.wait, args.retries): i for i, spec in enumerate(specs)}
+        for n, future in enumerate(as_completed(futures)):
+            i = futures[future]
+            job_dates, job_tiles = jobs[i]
+            results[i] = {"job": i, "start_date": job_dates[0], "end_date": job_dates[-1],
+                          "nbr_tiles": len(job_tiles), **future.result()}
+            status = "ok" if results[i]["returncode"] == 0 else "FAILED"
+            print(f"[{n + 1}/{len(specs)}] job {i} {job_dates[0]}..{job_dates[-1]} x {len(job_tiles)} tiles: {status}")
+
+    failed = [result for result in results if result["returncode"] != 0]
+    for result in failed:
+        print(f"job {result['job']} failed:\n{result['output']}")
+    print(f"{len(specs) - len(failed)}/{len(specs)} jobs {'finished' if args.wait else 'submitted'}")
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(results, f, indent=1)
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()